@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+PLY 建置輔助：若點雲檔不存在（或要求重建）則執行 reconstruct_simple.py 產生
+用法：
+    from build_ply import ensure_ply_exists
+    ensure_ply_exists('scan_images/result_visual_hull.ply', force_rebuild=False)
+
+ensure_ply_exists_async 為 asyncio 版本，等待重建子程序時不會阻塞事件迴圈；
+ensure_ply_exists 是給一般（非 async）程式使用的同步包裝。
+in_process=True 時改在本程序內呼叫 reconstruct_simple.rebuild，省去啟動子程序
+與重新匯入 numpy/cv2 的時間；重建輸出直接印到 stdout，不經 on_output/on_progress。
+
+重建結果會依 (grid_size, num_images, 掃描影像) 的指紋存入 .ply_cache/，並記錄目前的 PLY
+由哪個指紋產生；參數切換回先前組合時直接複製快取，不必重跑重建。
+"""
+import asyncio
+import codecs
+import hashlib
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SCAN_DIR = Path('scan_images')
+DEFAULT_PLY = SCAN_DIR / 'result_visual_hull.ply'
+RECONSTRUCT_SCRIPT = Path(__file__).resolve().with_name('reconstruct_simple.py')
+
+# 命令列中不變的前段；-u：子程序 stdout 為管線時不緩衝，進度才能即時回傳
+_BASE_CMD = (sys.executable, '-u', str(RECONSTRUCT_SCRIPT))
+
+# 設定環境變數 BUILD_PLY_DEBUG=1 時輸出實際執行的命令列
+DEBUG = bool(os.environ.get('BUILD_PLY_DEBUG'))
+
+# 重建腳本以 print(..., end='\r') 輸出 "進度: 12.3%"
+PROGRESS_RE = re.compile(r'進度:\s*([\d.]+)%')
+
+# Path.exists() 結果快取：UI 可能頻繁查詢同一個檔案，短時間內不重複 stat()
+EXISTS_TTL = 0.5  # 秒
+_exists_cache = {}  # str(path) -> (monotonic 時間, 是否存在)
+
+
+def cached_exists(path):
+    """帶 TTL 的 Path.exists()"""
+    key = str(path)
+    now = time.monotonic()
+    hit = _exists_cache.get(key)
+    if hit is not None and now - hit[0] < EXISTS_TTL:
+        return hit[1]
+    exists = Path(path).exists()
+    _exists_cache[key] = (now, exists)
+    return exists
+
+
+def clear_exists_cache(path=None):
+    """清除單一路徑（或全部）的存在快取"""
+    if path is None:
+        _exists_cache.clear()
+    else:
+        _exists_cache.pop(str(path), None)
+
+
+# 進行中的重建子程序 pid，供 terminate_builds() 在程式關閉時結束
+_running_pids = set()
+
+
+def terminate_builds():
+    """結束所有進行中的重建子程序（例如 UI 視窗關閉時），可於任何執行緒呼叫；
+    等待中的 ensure_ply_exists 會因子程序非 0 結束而拋出 CalledProcessError"""
+    for pid in list(_running_pids):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass  # 已自行結束
+
+
+# 重建結果的持久快取
+CACHE_DIR = Path('.ply_cache')
+CACHE_INDEX = CACHE_DIR / 'cache_index.json'
+CACHE_MAX_ENTRIES = 16
+# 目前各 PLY 是由哪個指紋產生：{PLY 絕對路徑: [指紋, mtime_ns, 大小]}
+BUILT_INDEX = CACHE_DIR / 'built_index.json'
+
+
+def source_fingerprint(grid_size, num_images, scan_dir=SCAN_DIR):
+    """以重建參數、輸入影像與重建腳本的 (名稱, mtime, 大小) 計算 blake2b 指紋"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{grid_size}|{num_images}'.encode())
+    # 與 reconstruct_simple.load_images 相同的檔名規則
+    sources = [Path(scan_dir) / f'{i:02d}.png' for i in range(1, num_images + 1)]
+    for path in sources + [RECONSTRUCT_SCRIPT]:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            h.update(f'|{path.name}:missing'.encode())
+            continue
+        h.update(f'|{path.name}:{st.st_mtime_ns}:{st.st_size}'.encode())
+    return h.hexdigest()
+
+
+def _load_cache_index(path=CACHE_INDEX):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_cache_index(index, path=CACHE_INDEX):
+    CACHE_DIR.mkdir(exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+
+
+def _stat_key(path):
+    """(mtime_ns, 大小)；檔案不存在時為 None"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def built_fingerprint(ply_path):
+    """產生目前 PLY 的指紋；沒有紀錄，或檔案之後被其他程式改寫（mtime/大小不符）時為 None"""
+    record = _load_cache_index(BUILT_INDEX).get(str(Path(ply_path).resolve()))
+    key = _stat_key(ply_path)
+    if record is None or key is None or tuple(record[1:]) != key:
+        return None
+    return record[0]
+
+
+def _record_built(ply_path, fingerprint):
+    """記錄 ply_path 目前的內容由 fingerprint 產生"""
+    index = _load_cache_index(BUILT_INDEX)
+    index[str(Path(ply_path).resolve())] = [fingerprint, *_stat_key(ply_path)]
+    _save_cache_index(index, BUILT_INDEX)
+
+
+def cache_lookup(fingerprint, ply_path):
+    """快取命中時把 PLY 複製到 ply_path 並回傳 True"""
+    cached = CACHE_DIR / f'{fingerprint}.ply'
+    if not cached.exists():
+        return False
+    ply_path = Path(ply_path)
+    ply_path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(cached, ply_path)
+    index = _load_cache_index()
+    index[fingerprint] = time.time()
+    _save_cache_index(index)
+    return True
+
+
+def cache_store(fingerprint, ply_path):
+    """將剛建好的 PLY 存入快取，超過 CACHE_MAX_ENTRIES 時淘汰最久未使用者"""
+    CACHE_DIR.mkdir(exist_ok=True)
+    shutil.copyfile(ply_path, CACHE_DIR / f'{fingerprint}.ply')
+    index = _load_cache_index()
+    index[fingerprint] = time.time()
+    for old in sorted(index, key=index.get)[:max(0, len(index) - CACHE_MAX_ENTRIES)]:
+        (CACHE_DIR / f'{old}.ply').unlink(missing_ok=True)
+        del index[old]
+    _save_cache_index(index)
+
+
+def build_command(ply_path, grid_size=40, num_images=8):
+    """組出重建子程序的命令列（不開啟重建腳本自己的 3D 視窗，顯示交給呼叫端）"""
+    return [*_BASE_CMD,
+            '--grid_size', str(grid_size),
+            '--num_images', str(num_images),
+            '--output', str(ply_path),
+            '--no_display']
+
+
+async def _relay_output(stream, on_output, on_progress):
+    """讀取子程序輸出並以 \r 或 \n 切行：進度行交給 on_progress，其餘交給 on_output"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = await stream.read(4096)
+        pending += decoder.decode(chunk, final=not chunk)
+        *lines, pending = re.split(r'[\r\n]', pending)
+        if not chunk:
+            lines.append(pending)
+        for line in lines:
+            line = line.rstrip()
+            if not line:
+                continue
+            m = PROGRESS_RE.search(line)
+            if m and on_progress:
+                on_progress(float(m.group(1)))
+            elif on_output:
+                on_output(line)
+        if not chunk:
+            break
+
+
+def _rebuild_in_process(ply_path, grid_size, num_images):
+    """在本程序內重建；沒有產生 PLY 時拋出 RuntimeError"""
+    # 延遲匯入：只用快取或子程序的呼叫端不必載入 cv2/matplotlib
+    import reconstruct_simple
+    Path(ply_path).parent.mkdir(parents=True, exist_ok=True)
+    if reconstruct_simple.rebuild(str(ply_path), grid_size=grid_size, num_images=num_images) is None:
+        raise RuntimeError(f'重建未產生 {ply_path}')
+
+
+async def ensure_ply_exists_async(ply_path=DEFAULT_PLY, force_rebuild=False,
+                                  grid_size=40, num_images=8, on_output=print,
+                                  on_progress=None, use_cache=True, in_process=False):
+    """
+    確保 PLY 存在；必要時以非同步子程序執行重建腳本。
+    子程序輸出逐行交給 on_output；若提供 on_progress，進度行改以百分比 (float) 回報。
+    PLY 已存在且正是這組 (grid_size, num_images, 影像) 產生的（見 built_fingerprint）時直接回傳；
+    來源不明或參數不同時，use_cache 為 True 會先查 .ply_cache/，命中則直接複製。
+    force_rebuild 只影響參數相同的情況：不沿用現有 PLY、也不查快取，一定重跑重建；
+    重建結果仍會寫回快取。
+    失敗時拋出 CalledProcessError；in_process 時則是重建程式本身的例外。
+    重建結束卻未寫出 PLY 時（兩種方式皆然）拋出 RuntimeError。回傳 PLY 路徑。
+    """
+    ply_path = Path(ply_path)
+    fingerprint = source_fingerprint(grid_size, num_images)
+    current = built_fingerprint(ply_path) if cached_exists(ply_path) else None
+    if current == fingerprint and not force_rebuild:
+        return ply_path
+
+    # 目前的 PLY 不是這組參數與輸入產生的：先查快取；同一指紋的強制重建則一定重跑
+    if use_cache and current != fingerprint and cache_lookup(fingerprint, ply_path):
+        clear_exists_cache(ply_path)
+        _record_built(ply_path, fingerprint)
+        if on_output:
+            on_output(f'使用快取結果 ({fingerprint[:8]})，略過重建')
+        if on_progress:
+            on_progress(100.0)
+        return ply_path
+
+    if in_process:
+        # 重建會佔用 CPU 數秒，放到執行緒中以免阻塞事件迴圈
+        try:
+            await asyncio.to_thread(_rebuild_in_process, ply_path, grid_size, num_images)
+        finally:
+            clear_exists_cache(ply_path)
+        _record_built(ply_path, fingerprint)
+        if use_cache:
+            cache_store(fingerprint, ply_path)
+        return ply_path
+
+    cmd = build_command(ply_path, grid_size, num_images)
+    before = _stat_key(ply_path)
+    if DEBUG and on_output:
+        on_output(' '.join(cmd))
+    # 子程序輸出含中文與符號，強制 UTF-8 以免在 Windows 的管線編碼下失敗
+    env = dict(os.environ, PYTHONIOENCODING='utf-8')
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env)
+    _running_pids.add(proc.pid)
+    try:
+        await _relay_output(proc.stdout, on_output, on_progress)
+        await proc.wait()
+    finally:
+        _running_pids.discard(proc.pid)
+    # 重建後檔案狀態已改變，下一次查詢必須回到磁碟
+    clear_exists_cache(ply_path)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    # 結束碼 0 但檔案未被改寫（舊版腳本或未產生點）時不可把舊 PLY 當成這次的結果存入快取
+    after = _stat_key(ply_path)
+    if after is None or after == before:
+        raise RuntimeError(f'重建未產生 {ply_path}')
+    _record_built(ply_path, fingerprint)
+    if use_cache:
+        cache_store(fingerprint, ply_path)
+    return ply_path
+
+
+def ensure_ply_exists(ply_path=DEFAULT_PLY, force_rebuild=False,
+                      grid_size=40, num_images=8, on_output=print, on_progress=None,
+                      use_cache=True, in_process=False):
+    """同步版本：不可在已執行中的 asyncio 事件迴圈內呼叫（請改 await async 版本）"""
+    return asyncio.run(ensure_ply_exists_async(ply_path, force_rebuild, grid_size,
+                                               num_images, on_output, on_progress,
+                                               use_cache, in_process))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+體素雕刻共用模組（reconstruct_from_8images、reconstruct_visual_hull 與 scan_and_reconstruct 共用）
+用法：
+    from carver import carve
+    active = carve(voxels, silhouettes, project)  # 保留體素在 voxels 中的索引（遞增）
+
+各腳本的相機模型不同，只有投影函式不同：project(pts, k) 回傳 pts 在第 k 個視角的
+(px, py, valid)，即整數像素座標與深度有效遮罩。雕刻規則相同：投影必須在相機前方、
+在影像內且落在輪廓前景 (非 0) 上，任一視角不符即移除該體素。
+silhouettes 可為各視角尺寸不同的 list：範圍以每個視角自己的前景外接矩形判斷。
+"""
+import numpy as np
+
+
+def silhouette_bounds(silhouettes):
+    """
+    每張輪廓前景的外接矩形 (u_lo, u_hi, v_lo, v_hi)，各為長度 N 的陣列（含端點）
+    沒有前景的輪廓回傳 u_lo > u_hi，任何投影都不會落在其中
+    """
+    bounds = np.empty((4, len(silhouettes)), dtype=np.int64)
+    for i, sil in enumerate(silhouettes):
+        cols = np.flatnonzero(sil.any(axis=0))
+        rows = np.flatnonzero(sil.any(axis=1))
+        if len(cols) == 0:
+            bounds[:, i] = (0, -1, 0, -1)
+        else:
+            bounds[:, i] = (cols[0], cols[-1], rows[0], rows[-1])
+    return bounds
+
+
+def view_order(silhouettes):
+    """前景面積由小到大的視角順序：面積小的視角最可能移除體素，先檢查它們，後面的視角要投影的體素就少"""
+    areas = [np.count_nonzero(sil) for sil in silhouettes]
+    return np.argsort(areas, kind='stable')
+
+
+def carve(voxels, silhouettes, project, active=None, views=None, verbose=True):
+    """
+    逐視角雕刻 voxels (M, 3)，回傳保留體素的索引
+    active: 只檢查這些索引（例如粗略雕刻後剩下的），預設為全部
+    views: 檢查視角的順序（可包上 tqdm），預設為 view_order(silhouettes)
+    """
+    if active is None:
+        active = np.arange(len(voxels))
+    if views is None:
+        views = view_order(silhouettes)
+    # 前景外接矩形在影像範圍內，落在矩形外的投影不必再查輪廓
+    u_lo, u_hi, v_lo, v_hi = silhouette_bounds(silhouettes)
+
+    # 每個視角一次投影整批體素，只投影前面視角留下的體素（對應逐體素迴圈的提早 break）
+    for step, k in enumerate(views):
+        if verbose:
+            print(f"  進度: {step + 1}/{len(silhouettes)} 視角", end='\r')
+        if len(active) == 0:
+            break
+        px, py, valid = project(voxels[active], k)
+        valid &= (px >= u_lo[k]) & (px <= u_hi[k]) & (py >= v_lo[k]) & (py <= v_hi[k])
+        valid[valid] = silhouettes[k][py[valid], px[valid]] != 0
+        active = active[valid]
+    return active
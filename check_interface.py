@@ -5,20 +5,10 @@ Interactive checklist UI for the Arduino 3D scanning system.
 Displays hardware status, capture progress, and reconstruction results.
 """
 
-import sys
+import itertools
 import tkinter as tk
 from tkinter import ttk, messagebox
-import os
 import time
-import threading
-import serial
-import json
-from datetime import datetime
-
-try:
-    import cv2
-except ImportError:
-    cv2 = None
 
 # Color scheme matching check.png design
 COLOR_BG = "#FFFFFF"  # White background
@@ -34,8 +24,25 @@ CROSS = "✗"
 PENDING = "○"
 LOADING = "⟳"
 
+# Timestamp string is only re-formatted when the wall-clock second changes
+_clock_sec = None
+_clock_str = ""
+
+
+def _timestamp():
+    """Current time as HH:MM:SS, cached per second."""
+    global _clock_sec, _clock_str
+    sec = int(time.time())
+    if sec != _clock_sec:
+        _clock_sec = sec
+        _clock_str = time.strftime("%H:%M:%S", time.localtime(sec))
+    return _clock_str
+
 class CheckItem:
     """Represents a single check item with status."""
+    __slots__ = ("title", "description", "status", "timestamp", "details")
+    _ICONS = {"success": CHECKMARK, "failed": CROSS, "loading": LOADING, "pending": PENDING}
+
     def __init__(self, title, description=""):
         self.title = title
         self.description = description
@@ -45,28 +52,11 @@ class CheckItem:
 
     def set_status(self, status, details=""):
         self.status = status
-        self.timestamp = datetime.now().strftime("%H:%M:%S")
+        self.timestamp = _timestamp()
         self.details = details
 
     def get_icon(self):
-        if self.status == "success":
-            return CHECKMARK
-        elif self.status == "failed":
-            return CROSS
-        elif self.status == "loading":
-            return LOADING
-        else:
-            return PENDING
-
-    def get_color(self):
-        if self.status == "success":
-            return COLOR_GREEN
-        elif self.status == "failed":
-            return COLOR_RED
-        elif self.status == "loading":
-            return COLOR_BLUE
-        else:
-            return COLOR_GRAY
+        return self._ICONS.get(self.status, PENDING)
 
 
 class ChecklistFrame(ttk.Frame):
@@ -76,7 +66,10 @@ class ChecklistFrame(ttk.Frame):
         super().__init__(root, **kwargs)
         self.root = root
         self.items = []
-        self.item_widgets = {}
+        # One shared spinner timer for every item currently in "loading"
+        self._spinner = itertools.cycle("⟳↻⟲")
+        self._loading_indices = set()
+        self._spinner_job = None
         
         self._create_header()
         self._create_checklist()
@@ -96,28 +89,37 @@ class ChecklistFrame(ttk.Frame):
         subtitle_label.pack(anchor=tk.W)
     
     def _create_checklist(self):
-        """Create scrollable checklist."""
-        # Create canvas with scrollbar
-        canvas_frame = ttk.Frame(self)
-        canvas_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-        
-        canvas = tk.Canvas(canvas_frame, bg=COLOR_BG, highlightthickness=0)
-        scrollbar = ttk.Scrollbar(canvas_frame, orient=tk.VERTICAL, command=canvas.yview)
-        scrollable_frame = ttk.Frame(canvas)
+        """Create the checklist as a single Treeview (one row per item)."""
+        tree_frame = ttk.Frame(self)
+        tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         
-        scrollable_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-        )
+        style = ttk.Style(self)
+        style.configure("Checklist.Treeview", background=COLOR_BG,
+                        fieldbackground=COLOR_BG, foreground=COLOR_TEXT,
+                        font=("Arial", 10), rowheight=32)
+        style.configure("Checklist.Treeview.Heading", font=("Arial", 10, "bold"))
         
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
+        self.tree = ttk.Treeview(tree_frame, columns=("status", "title", "detail", "time"),
+                                 show="headings", height=9, selectmode="none",
+                                 style="Checklist.Treeview")
+        for col, heading, width, stretch in (("status", "", 40, False),
+                                             ("title", "項目", 110, False),
+                                             ("detail", "說明", 220, True),
+                                             ("time", "時間", 70, False)):
+            self.tree.heading(col, text=heading)
+            self.tree.column(col, width=width, stretch=stretch,
+                             anchor=tk.CENTER if col in ("status", "time") else tk.W)
+        # Row colour follows the item status
+        self.tree.tag_configure("pending", foreground=COLOR_LIGHT_TEXT)
+        self.tree.tag_configure("loading", foreground=COLOR_BLUE)
+        self.tree.tag_configure("success", foreground=COLOR_GREEN)
+        self.tree.tag_configure("failed", foreground=COLOR_RED)
         
-        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        self.checklist_frame = scrollable_frame
-        
         # Initialize with default items
         self._add_default_items()
     
@@ -141,45 +143,14 @@ class ChecklistFrame(ttk.Frame):
     def add_item(self, check_item):
         """Add an item to the checklist."""
         self.items.append(check_item)
-        
-        # Create item frame
-        item_frame = tk.Frame(self.checklist_frame, bg=COLOR_BG)
-        item_frame.pack(fill=tk.X, pady=8, padx=5)
-        
-        # Icon/Status
-        status_label = tk.Label(item_frame, text=check_item.get_icon(), 
-                               bg=COLOR_BG, fg=check_item.get_color(),
-                               font=("Arial", 14, "bold"), width=3)
-        status_label.pack(side=tk.LEFT, padx=10)
-        
-        # Text content
-        text_frame = tk.Frame(item_frame, bg=COLOR_BG)
-        text_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        
-        title_label = tk.Label(text_frame, text=check_item.title,
-                              bg=COLOR_BG, fg=COLOR_TEXT,
-                              font=("Arial", 11, "bold"), justify=tk.LEFT)
-        title_label.pack(anchor=tk.W)
-        
-        detail_label = tk.Label(text_frame, text=check_item.description,
-                               bg=COLOR_BG, fg=COLOR_LIGHT_TEXT,
-                               font=("Arial", 9), justify=tk.LEFT)
-        detail_label.pack(anchor=tk.W)
-        
-        # Timestamp
-        if check_item.timestamp:
-            time_label = tk.Label(text_frame, text=f"[{check_item.timestamp}]",
-                                 bg=COLOR_BG, fg=COLOR_GRAY,
-                                 font=("Arial", 8))
-            time_label.pack(anchor=tk.E)
-        
-        # Store references for updating
-        self.item_widgets[len(self.items) - 1] = {
-            'frame': item_frame,
-            'status_label': status_label,
-            'title_label': title_label,
-            'detail_label': detail_label
-        }
+        self.tree.insert("", tk.END, iid=str(len(self.items) - 1),
+                         values=self._row_values(check_item, check_item.description),
+                         tags=(check_item.status,))
+    
+    @staticmethod
+    def _row_values(item, detail):
+        return (item.get_icon(), item.title, detail,
+                f"[{item.timestamp}]" if item.timestamp else "")
     
     def update_item(self, index, status, description=""):
         """Update an item's status."""
@@ -191,27 +162,34 @@ class ChecklistFrame(ttk.Frame):
         item.set_status(status, description)
         
         # Update UI
-        widgets = self.item_widgets[index]
-        widgets['status_label'].config(text=item.get_icon(), 
-                                       fg=item.get_color())
-        widgets['detail_label'].config(text=description)
+        self.tree.item(str(index), values=self._row_values(item, description),
+                       tags=(status,))
         
         # Add visual feedback
         if status == "loading":
-            self._animate_loading(widgets['status_label'])
+            self._loading_indices.add(index)
+            if self._spinner_job is None:
+                self._spinner_job = self.root.after(500, self._tick_loaders)
+        else:
+            self._loading_indices.discard(index)
+            if not self._loading_indices:
+                self._cancel_spinner()
     
-    def _animate_loading(self, label):
-        """Animate the loading icon."""
-        symbols = ["⟳", "↻", "⟲"]
-        idx = [0]
-        
-        def animate():
-            if label.winfo_exists():
-                label.config(text=symbols[idx[0] % len(symbols)])
-                idx[0] += 1
-                self.root.after(500, animate)
-        
-        animate()
+    def _cancel_spinner(self):
+        """Cancel the pending spinner tick, if any."""
+        if self._spinner_job is not None:
+            self.root.after_cancel(self._spinner_job)
+            self._spinner_job = None
+    
+    def _tick_loaders(self):
+        """Advance the spinner on all loading items; stops when none are left."""
+        self._spinner_job = None
+        if not self._loading_indices:
+            return
+        symbol = next(self._spinner)
+        for i in self._loading_indices:
+            self.tree.set(str(i), "status", symbol)
+        self._spinner_job = self.root.after(500, self._tick_loaders)
     
     def _create_buttons(self):
         """Create action buttons."""
@@ -247,12 +225,15 @@ class ChecklistFrame(ttk.Frame):
     
     def _on_reset(self):
         """Reset all items."""
-        for i in range(len(self.items)):
-            self.items[i].status = "pending"
-            self.items[i].timestamp = None
-            widgets = self.item_widgets[i]
-            widgets['status_label'].config(text=PENDING, fg=COLOR_GRAY)
-            widgets['detail_label'].config(text=self.items[i].description)
+        self._loading_indices.clear()
+        self._cancel_spinner()
+        for i, item in enumerate(self.items):
+            if item.status == "pending" and item.timestamp is None:
+                continue  # Row already shows its initial state
+            item.status = "pending"
+            item.timestamp = None
+            self.tree.item(str(i), values=self._row_values(item, item.description),
+                           tags=("pending",))
     
     def _on_export(self):
         """Export results."""
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+凸包前處理：先剔除不可能成為凸包頂點的點，再交給 ConvexHull
+用法：
+    from hull_utils import hull_candidates, hull_mesh, cached_hull_mesh
+    hull = ConvexHull(hull_candidates(pts))
+    verts, simplices, volume = hull_mesh(pts)  # 只含凸包頂點的三角網格
+    verts, simplices, volume = cached_hull_mesh(path, pts)  # 同上，結果存於 PLY 旁的 .hull.npz
+
+體素重建輸出的點落在規則網格上，同一條軸向直線上夾在兩端之間的點
+是兩端點的凸組合，不會是凸包頂點。只保留在 x、y、z 三個方向的直線上
+都位於端點的點，凸包與原始點雲完全相同，但 Qhull 的輸入少很多。
+"""
+import os
+
+import numpy as np
+
+from ply_io import file_key
+
+
+def _line_extremes(pts, axis):
+    """標記每條平行於 axis 的直線上（其餘兩座標相同）axis 座標最小或最大的點"""
+    others = [a for a in range(3) if a != axis]
+    # 依 (其餘兩座標, axis 座標) 排序，同一直線的點相鄰且依 axis 遞增
+    order = np.lexsort((pts[:, axis], pts[:, others[1]], pts[:, others[0]]))
+    key = pts[order][:, others]
+    starts = np.flatnonzero(np.r_[True, np.any(key[1:] != key[:-1], axis=1)])
+    ends = np.r_[starts[1:] - 1, len(order) - 1]
+    mask = np.zeros(len(pts), dtype=bool)
+    mask[order[starts]] = True
+    mask[order[ends]] = True
+    return mask
+
+
+def hull_candidates(pts):
+    """回傳可能成為凸包頂點的點（pts 的子集，順序不變）"""
+    if len(pts) < 4:
+        return pts
+    keep = _line_extremes(pts, 2)
+    if keep.mean() > 0.5:
+        # 不是網格狀點雲（幾乎每條直線只有一點），篩選沒有效果
+        return pts
+    for axis in (1, 0):
+        sub = np.flatnonzero(keep)
+        keep[sub] = _line_extremes(pts[sub], axis)
+    return pts[keep]
+
+
+def hull_mesh(pts):
+    """
+    計算 pts（至少 4 點）的凸包，回傳 (頂點 (V, 3), 三角形索引 (F, 3) int32, 體積)
+    只保留凸包頂點並重新編號三角形索引，三角形一律朝外（右手定則），
+    繪圖與快取都不必帶著整個點雲
+    """
+    from scipy.spatial import ConvexHull
+    candidates = hull_candidates(pts)
+    hull = ConvexHull(candidates)
+    verts = np.ascontiguousarray(candidates[hull.vertices])
+    remap = np.empty(len(candidates), dtype=np.int32)
+    remap[hull.vertices] = np.arange(len(hull.vertices), dtype=np.int32)
+    simplices = remap[hull.simplices]
+    # Qhull 的 simplices 方向不一致：法向量與面方程式的外法向相反者交換兩個頂點
+    tri = verts[simplices].astype(np.float64)
+    normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    flip = np.einsum('ij,ij->i', normals, hull.equations[:, :3]) < 0
+    simplices[flip] = simplices[flip][:, ::-1]
+    return verts, simplices, hull.volume
+
+
+def cached_hull_mesh(path, pts):
+    """
+    pts 為 PLY 檔 path 的頂點；hull_mesh 的結果快取在 path + '.hull.npz'，
+    以 PLY 的 (mtime_ns, 大小) 為鍵，PLY 未變時跨程序直接載入，不必重跑 Qhull
+    """
+    cache = os.fspath(path) + '.hull.npz'
+    key = np.array(file_key(path)[1:], dtype=np.int64)
+    try:
+        with np.load(cache) as data:
+            if np.array_equal(data['key'], key):
+                return data['verts'], data['simplices'], float(data['volume'])
+    except (OSError, KeyError, ValueError):
+        pass  # 沒有快取或快取損毀：重新計算
+    verts, simplices, volume = hull_mesh(pts)
+    tmp = cache + '.tmp.npz'
+    try:
+        np.savez(tmp, key=key, verts=verts, simplices=simplices, volume=volume)
+        os.replace(tmp, cache)
+    except OSError as e:
+        print('凸包快取寫入失敗:', e)
+    return verts, simplices, volume
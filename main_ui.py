@@ -5,48 +5,77 @@
     python main_ui.py
 
 功能：
-- 執行重建（呼叫 reconstruct_simple.py）
-- 讀取與顯示 PLY（內嵌 Matplotlib）
+- 執行重建（經 build_ply 呼叫 reconstruct_simple.py，於背景執行緒進行）
+- 讀取與顯示 PLY（讀檔與凸包於背景執行緒計算，內嵌 Matplotlib 繪製）
 - 顯示日誌輸出
 - 開啟 scan_images 資料夾
 """
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-import threading
+import functools
+import queue
 import subprocess
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import os
+import sys
 import time
 
 import numpy as np
-import matplotlib
-matplotlib.use('TkAgg')
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from scipy.spatial import ConvexHull
-
-# PLY 讀取器（ASCII）
-def load_ply_ascii(path):
-    pts = []
-    with open(path, 'r') as f:
-        header_ended = False
-        for line in f:
-            line = line.strip()
-            if not header_ended:
-                if line == 'end_header':
-                    header_ended = True
-                continue
-            if line:
-                parts = line.split()
-                if len(parts) >= 3:
-                    try:
-                        x, y, z = map(float, parts[:3])
-                        pts.append([x, y, z])
-                    except:
-                        continue
-    return np.array(pts, dtype=np.float32)
+
+from build_ply import (ensure_ply_exists, cached_exists, built_fingerprint, source_fingerprint,
+                       terminate_builds)
+from ply_io import load_ply, file_key
+from hull_utils import cached_hull_mesh
+
+LOG_MAX_LINES = 500
+PUMP_MAX_MSGS = 1000  # 每次 _pump 最多處理的訊息數，避免大量輸出時 UI 執行緒一次卡太久
+
+# 外部程式（檔案管理員、檢視器）自成一個 session，不隨主程式的 Ctrl-C 一起結束，
+# 輸出也不混進主程式的終端機
+DETACHED = dict(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+if os.name != 'nt':
+    DETACHED['start_new_session'] = True
+
+# matplotlib / scipy 載入需時，延後到第一次顯示點雲時才匯入，加快 UI 啟動
+Figure = FigureCanvasTkAgg = Poly3DCollection = Line3DCollection = None
+
+def _lazy_mpl():
+    global Figure, FigureCanvasTkAgg, Poly3DCollection, Line3DCollection
+    if Figure is None:
+        import matplotlib
+        import matplotlib.style
+        matplotlib.use('TkAgg')
+        # 'fast' 樣式開啟路徑簡化與分段繪製，大量點/線段時重繪較快
+        matplotlib.style.use('fast')
+        matplotlib.rcParams.update({'path.simplify': True,
+                                    'path.simplify_threshold': 1.0,
+                                    'agg.path.chunksize': 10000})
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from mpl_toolkits.mplot3d import Axes3D  # 註冊 '3d' projection
+        from mpl_toolkits.mplot3d.art3d import Poly3DCollection, Line3DCollection
+
+@functools.lru_cache(maxsize=2)
+def _hull_cached(path, mtime_ns, size):
+    pts = load_ply(path)
+    if len(pts) < 4:
+        return pts, None, len(pts)
+    # 只保留凸包頂點的三角網格，繪圖與快取都不必帶著整個點雲；
+    # 結果也存在 PLY 旁的 .hull.npz，重新開啟程式時不必重跑 Qhull
+    from scipy.spatial import QhullError
+    try:
+        verts, simplices, _ = cached_hull_mesh(path, pts)
+    except QhullError:
+        # 點全在同一平面或直線上（凸包退化），改以散點顯示
+        return pts, None, len(pts)
+    verts.flags.writeable = simplices.flags.writeable = False
+    return verts, simplices, len(pts)
+
+def load_hull(path):
+    """讀取 PLY 並計算凸包，依 (路徑, mtime, 大小) 快取；
+    回傳 (凸包頂點, 三角形索引, 原始點數)，點數不足 4 或凸包退化時回傳 (全部點, None, 點數)"""
+    return _hull_cached(*file_key(path))
 
 class MainUI:
     def __init__(self, root):
@@ -54,6 +83,8 @@ class MainUI:
         root.title('3D Scan — 主控介面')
         self.base_dir = Path.cwd()
         self.ply_path = Path('scan_images') / 'result_visual_hull.ply'
+        # 資料夾絕對路徑只解析一次，按鈕點擊時不再 stat
+        self._scan_folder = str((self.base_dir / 'scan_images').resolve())
 
         # 參數區
         param_frame = ttk.LabelFrame(root, text='參數')
@@ -80,60 +111,132 @@ class MainUI:
         self.open_folder_btn = ttk.Button(btn_frame, text='開啟 scan_images', command=self.open_scan_folder)
         self.open_folder_btn.grid(row=0, column=2, padx=4)
 
+        self.external_view_btn = ttk.Button(btn_frame, text='外部檢視器', command=self.open_external_viewer)
+        self.external_view_btn.grid(row=1, column=0, padx=4, pady=(0, 6), sticky='w')
+
         self.force_rebuild_var = tk.BooleanVar(value=False)
         ttk.Checkbutton(btn_frame, text='強制重建 (--rebuild)', variable=self.force_rebuild_var).grid(row=0, column=3, padx=6)
 
+        self.progress_var = tk.DoubleVar(value=0.0)
+        ttk.Progressbar(btn_frame, variable=self.progress_var, maximum=100, length=160).grid(row=0, column=4, padx=6)
+
         # Matplotlib 畫布
         plot_frame = ttk.LabelFrame(root, text='3D 檢視')
         plot_frame.grid(row=2, column=0, sticky='nsew', padx=8, pady=6)
         root.rowconfigure(2, weight=1)
         root.columnconfigure(0, weight=1)
 
-        self.fig = plt.Figure(figsize=(6,5))
-        self.ax = self.fig.add_subplot(111, projection='3d')
-        self.canvas = FigureCanvasTkAgg(self.fig, master=plot_frame)
-        self.canvas.get_tk_widget().pack(fill='both', expand=True)
+        # 畫布於第一次顯示時才建立（見 _ensure_canvas）
+        self.plot_frame = plot_frame
+        self.fig = self.ax = self.canvas = None
+        self._faces = self._edges = None  # 重複使用的凸包 artist
+        self._scatter = None  # 重複使用的散點 artist（點數不足以建凸包時）
+        self.plot_placeholder = ttk.Label(plot_frame, text='尚未載入點雲', anchor='center')
+        self.plot_placeholder.pack(fill='both', expand=True)
 
         # 日誌區
         log_frame = ttk.LabelFrame(root, text='執行日誌')
         log_frame.grid(row=3, column=0, sticky='ew', padx=8, pady=6)
         self.log = tk.Text(log_frame, height=8)
         self.log.pack(fill='both', expand=True)
+        # 背景執行緒不直接碰 Tk：所有結果都以 (種類, 參數...) 放進 msg_q，
+        # 由 UI 執行緒每 50ms 的 _pump 統一取出處理
+        self.msg_q = queue.Queue()
+        self.root.after(50, self._pump)
+
+        # 背景建置：單一長駐工作執行緒依序處理重建（同時只會有一個重建寫入 PLY），
+        # 完成時經 msg_q 交回 UI 執行緒
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # 讀檔與凸包計算另用一條執行緒，重建進行中也能檢視，且不卡住 UI 執行緒
+        self._loader = ThreadPoolExecutor(max_workers=1)
+        # 工作執行緒不是 daemon：關窗時須先取消排隊的工作並結束重建子程序，否則程式要等重建跑完才會退出
+        root.protocol('WM_DELETE_WINDOW', self.on_close)
 
         # 初始載入 PLY 若存在
-        if self.ply_path.exists():
+        if cached_exists(self.ply_path):
             self.log_insert(f'已找到 {self.ply_path}，可直接載入或重建。')
 
+    def on_close(self):
+        """關閉視窗：取消排隊的重建與載入、結束進行中的重建子程序後再銷毀視窗"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._loader.shutdown(wait=False, cancel_futures=True)
+        terminate_builds()
+        self.root.destroy()
+
     def log_insert(self, text):
+        """可於任何執行緒呼叫：訊息先進佇列，由 _pump 在 UI 執行緒批次寫入"""
         ts = time.strftime('%H:%M:%S')
-        self.log.insert('end', f'[{ts}] {text}\n')
-        self.log.see('end')
-
-    def run_subprocess(self, cmd, on_complete=None):
-        """在背景執行子程序，將 stdout/stderr 寫入日誌"""
-        def worker():
-            self.log_insert(f'執行: {" ".join(cmd)}')
-            try:
-                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-                for line in proc.stdout:
-                    self.log_insert(line.rstrip())
-                proc.wait()
-                self.log_insert(f'執行完成 (碼={proc.returncode})')
-                if on_complete:
-                    self.root.after(50, on_complete)
-            except Exception as e:
-                self.log_insert(f'執行錯誤: {e}')
+        self.msg_q.put(('log', f'[{ts}] {text}\n'))
 
-        threading.Thread(target=worker, daemon=True).start()
+    def _pump(self):
+        """UI 執行緒：每 50ms 取出佇列中的訊息（每次最多 PUMP_MAX_MSGS 則）；
+        日誌一次插入並只捲動一次，進度只套用最新一筆"""
+        lines = []
+        progress = None
+        done = []
+        try:
+            for _ in range(PUMP_MAX_MSGS):
+                msg = self.msg_q.get_nowait()
+                kind = msg[0]
+                if kind == 'log':
+                    lines.append(msg[1])
+                elif kind == 'progress':
+                    progress = msg[1]
+                else:
+                    done.append(msg)
+        except queue.Empty:
+            pass
+        if lines:
+            self.log.insert('end', ''.join(lines))
+            # 只保留最後 LOG_MAX_LINES 行，避免長時間重建時文字區無限成長
+            line_count = int(self.log.index('end-1c').split('.')[0])
+            if line_count > LOG_MAX_LINES:
+                self.log.delete('1.0', f'{line_count - LOG_MAX_LINES}.0')
+            self.log.see('end')
+        if progress is not None:
+            self.progress_var.set(progress)
+        # 先排定下一輪：完成處理可能開啟對話框（巢狀事件迴圈），期間日誌仍需更新
+        self.root.after(50, self._pump)
+        for kind, fut, arg in done:
+            if kind == 'build_done':
+                self._on_build_done(fut, arg)
+            elif kind == 'hull_loaded':
+                self._on_hull_loaded(fut, arg)
 
-    def on_rebuild(self):
-        # 呼叫 reconstruct_simple.py
+    def _submit_build(self, force_rebuild, on_complete=None):
+        """所有重建的唯一入口：排入背景執行緒，完成後於 UI 執行緒呼叫 on_complete"""
         grid = self.grid_size_var.get()
         num_images = self.num_images_var.get()
-        cmd = [sys.executable, 'reconstruct_simple.py', '--grid_size', str(grid), '--num_images', str(num_images)]
-        if self.force_rebuild_var.get():
-            cmd.append('--rebuild')
-        self.run_subprocess(cmd, on_complete=self.on_rebuild_complete)
+        self.log_insert(f'排入重建: grid={grid}, images={num_images}' + (' (強制)' if force_rebuild else ''))
+        self.progress_var.set(0.0)
+        fut = self._executor.submit(ensure_ply_exists, self.ply_path, force_rebuild,
+                                    grid, num_images, self.log_insert, self._set_progress)
+        fut.add_done_callback(lambda f: self.msg_q.put(('build_done', f, on_complete)))
+
+    def _set_progress(self, percent):
+        """背景執行緒：回報重建進度（百分比），同一次 _pump 內只套用最新值"""
+        self.msg_q.put(('progress', percent))
+
+    def _on_build_done(self, fut, on_complete):
+        """UI 執行緒：處理完成的重建工作"""
+        try:
+            fut.result()
+        except Exception as e:
+            self.log_insert(f'執行錯誤: {e}')
+            return
+        self.progress_var.set(100.0)
+        if on_complete:
+            on_complete()
+
+    def on_rebuild(self):
+        force = self.force_rebuild_var.get()
+        # 只有現有 PLY 正是以輸入的參數（與目前的影像）建成時才略過；參數不同時交給 build_ply 查快取或重建
+        fingerprint = source_fingerprint(self.grid_size_var.get(), self.num_images_var.get())
+        if not force and cached_exists(self.ply_path) and built_fingerprint(self.ply_path) == fingerprint:
+            self.log_insert(f'{self.ply_path} 已由相同參數建立，略過重建（勾選「強制重建」可重新產生）。')
+            self.on_view()
+            return
+        self._submit_build(force, on_complete=self.on_rebuild_complete)
 
     def on_rebuild_complete(self):
         self.log_insert('重建完成，嘗試載入 PLY 並顯示。')
@@ -144,74 +247,117 @@ class MainUI:
         if not path:
             # 若使用者取消，嘗試使用預設路徑
             path = str(self.ply_path)
-        if not Path(path).exists():
+        # 讀檔與 ConvexHull 在背景執行緒進行，結果經 msg_q 交回 UI 執行緒繪製
+        fut = self._loader.submit(load_hull, path)
+        fut.add_done_callback(lambda f: self.msg_q.put(('hull_loaded', f, path)))
+
+    def _on_hull_loaded(self, fut, path):
+        """UI 執行緒：繪製背景載入完成的凸包"""
+        # 不先呼叫 exists()：load_hull 本身的 os.stat 失敗即代表檔案不存在
+        try:
+            pts, simplices, n_points = fut.result()
+        except FileNotFoundError:
             resp = messagebox.askyesno('找不到 PLY', f'找不到 {path}，要自動重建並產生 PLY 嗎？')
             if resp:
-                self.on_rebuild()
+                self._submit_build(self.force_rebuild_var.get(), on_complete=self.on_rebuild_complete)
+            return
+        except Exception as e:
+            self.log_insert(f'載入 PLY 失敗: {e}')
             return
         try:
-            pts = load_ply_ascii(path)
-            self.display_points(pts)
-            self.log_insert(f'載入 {path} ({len(pts)} 點)')
+            self.display_points(pts, simplices, n_points)
+            self.log_insert(f'載入 {path} ({n_points} 點)')
         except Exception as e:
             self.log_insert(f'載入 PLY 失敗: {e}')
 
-    def display_points(self, pts):
-        self.ax.clear()
-        if len(pts) == 0:
-            self.ax.text(0.5, 0.5, 0.5, 'No points', transform=self.ax.transAxes)
-        else:
+    def _ensure_canvas(self):
+        """第一次繪圖時匯入 matplotlib 並建立內嵌畫布"""
+        if self.canvas is not None:
+            return
+        _lazy_mpl()
+        self.plot_placeholder.destroy()
+        self.fig = Figure(figsize=(6,5))
+        self.ax = self.fig.add_subplot(111, projection='3d')
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.plot_frame)
+        self.canvas.get_tk_widget().pack(fill='both', expand=True)
+
+    def display_points(self, pts, simplices=None, n_points=None):
+        """simplices 為預先算好的凸包三角形；None 時於此計算。n_points 為標題顯示的原始點數"""
+        self._ensure_canvas()
+        # 約定為 C 連續 float32（ply_io 的輸出已符合，此時不複製）
+        pts = np.ascontiguousarray(pts, dtype=np.float32)
+        if simplices is None and len(pts) >= 4:
             # 嘗試用 ConvexHull 畫填滿的簡單幾何形狀並疊上邊框
             try:
-                if len(pts) >= 4:
-                    hull = ConvexHull(pts)
-                    self.ax.plot_trisurf(pts[:,0], pts[:,1], pts[:,2],
-                                         triangles=hull.simplices, linewidth=0.2,
-                                         edgecolor='k', color='lightgreen', alpha=0.85)
-                    for tri in hull.simplices:
-                        tri_pts = pts[tri]
-                        xs, ys, zs = tri_pts[:,0], tri_pts[:,1], tri_pts[:,2]
-                        self.ax.plot(np.append(xs, xs[0]), np.append(ys, ys[0]), np.append(zs, zs[0]),
-                                     color='black', linewidth=0.25, alpha=0.8)
-                else:
-                    self.ax.scatter(pts[:,0], pts[:,1], pts[:,2], c='blue', s=2)
+                from scipy.spatial import ConvexHull
+                simplices = ConvexHull(pts).simplices
             except Exception as e:
                 self.log_insert(f'ConvexHull render failed: {e}')
-                self.ax.scatter(pts[:,0], pts[:,1], pts[:,2], c='blue', s=2)
+        if simplices is not None:
+            tris = pts[simplices]  # (F, 3, 3)
+            # 每個三角形的三條邊 (0,1) (1,2) (2,0)；封閉曲面上每條邊屬於兩個三角形，
+            # 以排序後的頂點索引去重，只畫一次
+            edges = np.sort(simplices[:, [[0, 1], [1, 2], [2, 0]]].reshape(-1, 2), axis=1)
+            segs = pts[np.unique(edges, axis=0)]  # (E, 2, 3)
+            if self._faces is None:
+                # 面與邊框各為單一 collection；之後重繪沿用同一組 artist
+                self.ax.clear()
+                self._scatter = None
+                self._faces = Poly3DCollection(tris, facecolor='lightgreen',
+                                               edgecolor='none', alpha=0.85)
+                self._edges = Line3DCollection(segs, colors='black',
+                                               linewidths=0.25, alpha=0.8)
+                self.ax.add_collection3d(self._faces)
+                self.ax.add_collection3d(self._edges)
+            else:
+                self._faces.set_verts(tris)
+                self._edges.set_segments(segs)
+        elif len(pts) == 0:
+            self.ax.clear()
+            self._faces = self._edges = self._scatter = None
+            self.ax.text(0.5, 0.5, 0.5, 'No points', transform=self.ax.transAxes)
+        else:
+            # 點數過多時抽樣顯示（最多約 20k 點）
+            step = max(1, len(pts) // 20000)
+            xs, ys, zs = pts[::step,0], pts[::step,1], pts[::step,2]
+            if self._scatter is None:
+                self.ax.clear()
+                self._faces = self._edges = None
+                self._scatter = self.ax.scatter(xs, ys, zs, c='blue', s=1)
+            else:
+                # 沿用同一個 Path3DCollection，只替換座標
+                self._scatter._offsets3d = (xs, ys, zs)
 
+        if len(pts) > 0:
             self.ax.set_xlabel('X')
             self.ax.set_ylabel('Y')
             self.ax.set_zlabel('Z')
-            self.ax.set_title(f'Point cloud ({len(pts)} points)')
-
-        # 等比例顯示
-        def set_axes_equal(ax):
-            x_limits = ax.get_xlim3d()
-            y_limits = ax.get_ylim3d()
-            z_limits = ax.get_zlim3d()
+            self.ax.set_title(f'Point cloud ({n_points or len(pts)} points)')
 
-            x_range = abs(x_limits[1] - x_limits[0])
-            x_middle = np.mean(x_limits)
-            y_range = abs(y_limits[1] - y_limits[0])
-            y_middle = np.mean(y_limits)
-            z_range = abs(z_limits[1] - z_limits[0])
-            z_middle = np.mean(z_limits)
+            # 等比例顯示：直接由點的包圍盒算出三軸範圍，不經 autoscale 再讀回 get_xlim3d
+            lo, hi = pts.min(axis=0), pts.max(axis=0)
+            mid = 0.5 * (lo + hi)
+            r = 0.5 * (hi - lo).max() or 0.5  # 所有點重合時給一個單位寬的範圍
+            self.ax.set_xlim3d(mid[0] - r, mid[0] + r)
+            self.ax.set_ylim3d(mid[1] - r, mid[1] + r)
+            self.ax.set_zlim3d(mid[2] - r, mid[2] + r)
 
-            plot_radius = 0.5 * max([x_range, y_range, z_range])
+        self.canvas.draw_idle()
 
-            ax.set_xlim3d([x_middle - plot_radius, x_middle + plot_radius])
-            ax.set_ylim3d([y_middle - plot_radius, y_middle + plot_radius])
-            ax.set_zlim3d([z_middle - plot_radius, z_middle + plot_radius])
-
-        set_axes_equal(self.ax)
-        self.canvas.draw()
+    def open_external_viewer(self):
+        """以獨立程序開啟 view_ply.py（有 pyvista 時由 GPU 繪製，不佔用本視窗）"""
+        if not cached_exists(self.ply_path):
+            self.log_insert(f'找不到 {self.ply_path}，請先重建。')
+            return
+        viewer = Path(__file__).resolve().with_name('view_ply.py')
+        subprocess.Popen([sys.executable, str(viewer), str(self.ply_path)], **DETACHED)
+        self.log_insert(f'已開啟外部檢視器: {self.ply_path}')
 
     def open_scan_folder(self):
-        folder = str(Path('scan_images').resolve())
         if os.name == 'nt':
-            os.startfile(folder)
+            os.startfile(self._scan_folder)
         else:
-            subprocess.Popen(['xdg-open', folder])
+            subprocess.Popen(['xdg-open', self._scan_folder], **DETACHED)
 
 if __name__ == '__main__':
     root = tk.Tk()
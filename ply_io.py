@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+PLY 讀寫共用模組（重建腳本、main_ui 與 view_ply 共用）
+用法：
+    from ply_io import load_ply, write_ply
+    pts = load_ply('scan_images/result_visual_hull.ply')  # (N, 3) float32，唯讀
+    write_ply('result.ply', pts)
+
+讀取支援 ascii 與 binary_little_endian / binary_big_endian 格式的頂點 x/y/z；
+寫出一律為 binary_little_endian float32。
+load_ply 以 (路徑, mtime, 大小) 快取解析結果；read_ply 每次都重新讀檔。
+"""
+import functools
+import os
+
+import numpy as np
+
+# PLY 屬性型別 -> NumPy 型別
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+def parse_ply_header(f):
+    """讀取 PLY 標頭（f 以二進位模式開啟），回傳 (format, 頂點數, 頂點屬性 [(名稱, 型別)])"""
+    fmt, n_vertex, props = None, 0, []
+    element = None
+    for raw in f:
+        line = raw.decode('ascii', errors='replace').strip()
+        if line == 'end_header':
+            break
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == 'format':
+            fmt = parts[1]
+        elif parts[0] == 'element':
+            element = parts[1]
+            if element == 'vertex':
+                n_vertex = int(parts[2])
+        elif parts[0] == 'property' and element == 'vertex':
+            if parts[1] == 'list':
+                raise ValueError('不支援 list 型別的頂點屬性')
+            props.append((parts[2], PLY_TYPES[parts[1]]))
+    else:
+        raise ValueError('PLY 標頭缺少 end_header')
+    return fmt, n_vertex, props
+
+# 二進位格式 -> NumPy 位元組順序
+BYTE_ORDER = {'binary_little_endian': '<', 'binary_big_endian': '>'}
+
+# PLY 讀取器（ASCII / 二進位）
+def read_ply(path):
+    """回傳頂點座標：C 連續的 (N, 3) float32 ndarray"""
+    with open(path, 'rb') as f:
+        fmt, n, props = parse_ply_header(f)
+        names = [name for name, _ in props]
+        header_len = f.tell()
+        if fmt in BYTE_ORDER:
+            if n == 0:
+                return np.empty((0, 3), dtype=np.float32)
+            # 二進位：以 memmap 直接映射頂點區塊（結構化 dtype），
+            # 不先讀成 bytes 再複製一次，只在組 (N,3) 陣列時讀取一遍
+            dtype = np.dtype([(name, BYTE_ORDER[fmt] + t) for name, t in props])
+            arr = np.memmap(path, dtype=dtype, mode='r', offset=header_len, shape=(n,))
+            return np.stack([arr['x'], arr['y'], arr['z']], axis=1).astype(np.float32, copy=False)
+        if fmt != 'ascii':
+            raise ValueError(f'不支援的 PLY 格式: {fmt}')
+        if n == 0:
+            return np.empty((0, 3), dtype=np.float32)
+        # 頂點資料交給 NumPy 以 C 迴圈解析，不逐行在 Python 端 split()/float()；
+        # 以標頭宣告的頂點數限制讀取列數，之後的 face 等元素不會被誤當成頂點
+        cols = tuple(names.index(c) for c in ('x', 'y', 'z'))
+        pts = np.loadtxt(f, dtype=np.float32, usecols=cols, ndmin=2, max_rows=n)
+    return np.ascontiguousarray(pts)
+
+
+# write_ply 每次轉換並寫出的頂點數（約 3 MB），轉型暫存不隨點雲大小成長
+WRITE_CHUNK = 262144
+
+
+def write_ply(path, points):
+    """將 (N, 3) 頂點寫成 binary_little_endian PLY：頂點區塊分段轉成 float32 寫出，不逐點格式化"""
+    pts = np.asarray(points).reshape(-1, 3)
+    header = ('ply\n'
+              'format binary_little_endian 1.0\n'
+              f'element vertex {len(pts)}\n'
+              'property float x\n'
+              'property float y\n'
+              'property float z\n'
+              'end_header\n')
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        for start in range(0, len(pts), WRITE_CHUNK):
+            chunk = np.ascontiguousarray(pts[start:start + WRITE_CHUNK], dtype='<f4')
+            f.write(memoryview(chunk).cast('B'))
+
+
+def file_key(path):
+    """快取鍵：(路徑, mtime_ns, 大小)；粗粒度 mtime 的檔案系統上，大小可辨識同一時刻內的覆寫"""
+    path = os.fspath(path)
+    st = os.stat(path)
+    return path, st.st_mtime_ns, st.st_size
+
+
+@functools.lru_cache(maxsize=8)
+def _load_ply_cached(path, mtime_ns, size):
+    pts = read_ply(path)
+    # 快取中的陣列會被多個呼叫者共用，設為唯讀避免被就地修改
+    pts.flags.writeable = False
+    return pts
+
+
+def load_ply(path):
+    """帶快取的 read_ply：檔案重建後 mtime 或大小改變，自動重新解析"""
+    return _load_ply_cached(*file_key(path))
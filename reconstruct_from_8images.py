@@ -7,11 +7,23 @@
 import cv2
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import json
-from scipy.spatial import ConvexHull
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+
+# 選用：安裝 CuPy 時可用 --device cuda 在 GPU 上雕刻
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+from carver import carve
+from hull_utils import hull_mesh
+from ply_io import write_ply
+import view_ply
 
 def load_images(scan_dir="scan_images"):
     """載入掃描影像"""
@@ -74,31 +86,135 @@ def camera_matrix(img_width, img_height, focal_length=None):
     
     return K
 
-def project_voxel_to_image(voxel_pos, camera_matrix, rotation, translation):
+def projection_matrices(camera_matrix, angles, radius):
     """
-    將 3D 體素投影到 2D 影像平面
-    使用相機外部參數
+    每個視角的 3×4 投影矩陣 P = K [R | t]，回傳 (N, 3, 4)
+    相機圍繞 Y 軸，旋轉矩陣簡化為單位矩陣，平移為相機位置
     """
-    # 世界座標轉相機座標
-    R = rotation
-    t = translation
-    
-    cam_pos = R @ voxel_pos + t
+    n = len(angles)
+    Rt = np.zeros((n, 3, 4))
+    Rt[:, :, :3] = np.eye(3)
+    Rt[:, 0, 3] = radius * np.cos(angles)
+    Rt[:, 2, 3] = radius * np.sin(angles)
+    return (camera_matrix.astype(np.float64) @ Rt).astype(np.float32)
+
+# 投影座標轉整數前的截斷範圍：接近相機平面時商可能極大，截到 ±2**30（仍遠在影像外）
+# 以免轉型溢位；截斷是單調的，不影響範圍判斷與 coarse_carve 的外接矩形
+PROJ_LIMIT = 2 ** 30
+
+def project_voxels_to_image(voxels, P):
+    """
+    以 3×4 投影矩陣將一批 3D 體素 (M, 3) 投影到 2D 影像平面
+    回傳 (px, py, valid)：valid 為 False 者位於相機後方
+    """
+    uvw = voxels @ P[:, :3].T + P[:, 3]
+    z = uvw[:, 2]
+    valid = z > 0
+    z = np.where(valid, z, 1.0)
+    # int() 截斷（向 0 取整）對應 astype；像素索引用 int32 即足夠
+    px = np.clip(uvw[:, 0] / z, -PROJ_LIMIT, PROJ_LIMIT).astype(np.int32)
+    py = np.clip(uvw[:, 1] / z, -PROJ_LIMIT, PROJ_LIMIT).astype(np.int32)
+    return px, py, valid
+
+def coarse_carve(xs, ys, zs, P, silhouettes, block=4):
+    """
+    粗略雕刻：以 block³ 個體素為一塊，整塊在某視角一定落在背景時一次移除
+    回傳 (len(zs), len(ys), len(xs)) 的布林遮罩，True 為仍需逐體素檢查者
+
+    區塊內體素中心都在其 8 個角點（最外側體素中心）張成的長方體內；
+    長方體全在相機前方時，投影落在角點投影的外接矩形內（int() 截斷為單調），
+    因此矩形內沒有前景像素（以積分影像查詢）就保證整塊都會被雕刻掉。
+    各視角影像尺寸可能不同，積分影像與矩形裁切都以該視角自己的 (h, w) 計算。
+    """
+    # 每塊在各軸上的第一個與最後一個體素座標
+    lo_hi = []
+    for c in (xs, ys, zs):
+        starts = np.arange(0, len(c), block)
+        ends = np.minimum(starts + block, len(c)) - 1
+        lo_hi.append(np.stack([c[starts], c[ends]], axis=1))
+    (bx, by, bz) = lo_hi
+    nz, ny, nx = len(bz), len(by), len(bx)
+    # 角點 (nz, ny, nx, 8, 3)
+    corners = np.empty((nz, ny, nx, 8, 3))
+    for k in range(8):
+        corners[..., k, 0] = bx[None, None, :, k & 1]
+        corners[..., k, 1] = by[None, :, None, (k >> 1) & 1]
+        corners[..., k, 2] = bz[:, None, None, (k >> 2) & 1]
+    corners = corners.reshape(-1, 8, 3)
     
-    # 透視投影
-    if cam_pos[2] > 0:
-        img_pos = camera_matrix @ (cam_pos / cam_pos[2])
-        return int(img_pos[0]), int(img_pos[1])
+    alive = np.ones(len(corners), dtype=bool)
+    for Pi, sil in zip(P, silhouettes):
+        h, w = sil.shape[:2]
+        # 積分影像：sat[v, u] 為 sil[:v, :u] 的前景像素數
+        sat = np.zeros((h + 1, w + 1), dtype=np.int64)
+        sat[1:, 1:] = np.cumsum(np.cumsum(sil != 0, axis=0), axis=1)
+        uvw = corners @ Pi[:, :3].T + Pi[:, 3]
+        z = uvw[..., 2]
+        front = z > 0
+        all_behind = ~front.any(axis=1)
+        all_front = front.all(axis=1)
+        z = np.where(front, z, 1.0)
+        u = np.clip(uvw[..., 0] / z, -PROJ_LIMIT, PROJ_LIMIT).astype(np.int64)
+        v = np.clip(uvw[..., 1] / z, -PROJ_LIMIT, PROJ_LIMIT).astype(np.int64)
+        # 外接矩形各放寬 1 像素，容許浮點捨入差異；裁切到影像範圍
+        u0 = np.maximum(u.min(axis=1) - 1, 0)
+        u1 = np.minimum(u.max(axis=1) + 1, w - 1)
+        v0 = np.maximum(v.min(axis=1) - 1, 0)
+        v1 = np.minimum(v.max(axis=1) + 1, h - 1)
+        empty = (u0 > u1) | (v0 > v1)
+        u0, u1 = np.minimum(u0, w - 1), np.maximum(u1, 0)
+        v0, v1 = np.minimum(v0, h - 1), np.maximum(v1, 0)
+        fg = sat[v1 + 1, u1 + 1] - sat[v0, u1 + 1] - sat[v1 + 1, u0] + sat[v0, u0]
+        alive &= ~(all_behind | (all_front & (empty | (fg == 0))))
     
-    return None
+    alive = alive.reshape(nz, ny, nx)
+    iz = np.arange(len(zs)) // block
+    iy = np.arange(len(ys)) // block
+    ix = np.arange(len(xs)) // block
+    return alive[np.ix_(iz, iy, ix)]
+
+def carve_voxels_cpu(xs, ys, zs, voxels, P, silhouettes):
+    """CPU 雕刻：區塊粗略雕刻後逐視角檢查剩餘體素（見 carver.carve），回傳保留體素的索引"""
+    # 先以區塊粗略雕刻，只有未被整塊移除的體素才逐一投影
+    active = np.flatnonzero(coarse_carve(xs, ys, zs, P, silhouettes))
+    return carve(voxels, silhouettes[:len(P)],
+                 lambda pts, k: project_voxels_to_image(pts, P[k]), active=active)
 
-def carve_voxels_simple(images, voxel_res=32, num_angles=8):
+def carve_voxels_cuda(voxels, P, silhouettes):
+    """
+    以 CuPy 在 GPU 上逐視角計算所有體素 (M) 的投影與輪廓查詢
+    各視角影像尺寸可能不同，影像範圍以該視角輪廓自己的 (h, w) 判斷；
+    判斷規則與 CPU 版相同，回傳保留體素的索引（NumPy 陣列）
+    """
+    V = cp.asarray(voxels)
+    keep = cp.ones(len(V), dtype=bool)
+    for Pi, sil in zip(P, silhouettes):
+        Pi = cp.asarray(Pi)
+        sil = cp.asarray(sil)
+        h, w = sil.shape[:2]
+        uvw = V @ Pi[:, :3].T + Pi[:, 3]
+        z = uvw[:, 2]
+        valid = z > 0
+        z = cp.where(valid, z, 1.0)
+        px = cp.clip(uvw[:, 0] / z, -PROJ_LIMIT, PROJ_LIMIT).astype(cp.int64)
+        py = cp.clip(uvw[:, 1] / z, -PROJ_LIMIT, PROJ_LIMIT).astype(cp.int64)
+        inside = valid & (px >= 0) & (px < w) & (py >= 0) & (py < h)
+        px = cp.where(inside, px, 0)
+        py = cp.where(inside, py, 0)
+        keep &= inside & (sil[py, px] != 0)
+    return cp.asnumpy(cp.flatnonzero(keep))
+
+def carve_voxels_simple(images, voxel_res=32, num_angles=8, device='cpu'):
     """
     簡化的體素雕刻
     如果體素在任何視角的投影上不在輪廓內，則移除
+    device='cuda' 且已安裝 CuPy 時改在 GPU 上計算
     """
     h, w = images[0].shape[:2]
-    silhouettes = [extract_silhouette(img) for img in images]
+    # OpenCV 運算會釋放 GIL，各影像的輪廓以執行緒平行提取
+    with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as ex:
+        silhouettes = list(ex.map(extract_silhouette, images))
+    # 各影像尺寸不一定相同（load_images 不縮放），輪廓保持 list，各視角以自己的尺寸判斷範圍
     
     # 建立體素網格（立方體空間）
     # 假設物體在 [-1, 1] × [-0.5, 0.5] × [-1, 1]
@@ -113,109 +229,71 @@ def carve_voxels_simple(images, voxel_res=32, num_angles=8):
     
     print("\n🔄 體素雕刻中...")
     
-    # 對每個體素檢查
-    carving_count = 0
-    for z in range(voxel_grid.shape[0]):
-        if z % 8 == 0:
-            print(f"  進度: {z}/{voxel_grid.shape[0]}", end='\r')
-        
-        for y in range(voxel_grid.shape[1]):
-            for x in range(voxel_grid.shape[2]):
-                # 體素 3D 座標 (正規化)
-                voxel_3d = np.array([
-                    (x - voxel_res / 2) / (voxel_res / 2),
-                    (y - voxel_res / 4) / (voxel_res / 4),
-                    (z - voxel_res / 2) / (voxel_res / 2),
-                    1.0
-                ])[:3]
-                
-                # 檢查此體素在每個相機視角是否可見
-                visible_in_all = True
-                for angle_idx, angle in enumerate(angles):
-                    # 相機位置（圍繞 Y 軸旋轉）
-                    cam_x = radius * np.cos(angle)
-                    cam_z = radius * np.sin(angle)
-                    cam_y = 0.0
-                    
-                    # 從相機指向物體中心的看向向量
-                    look_dir = np.array([0, 0, 0]) - np.array([cam_x, cam_y, cam_z])
-                    look_dir = look_dir / np.linalg.norm(look_dir)
-                    
-                    # 右向量和上向量
-                    right = np.array([1, 0, 0])  # 簡化
-                    up = np.cross(look_dir, right)
-                    up = up / np.linalg.norm(up)
-                    right = np.cross(up, look_dir)
-                    
-                    # 建立旋轉矩陣 (簡化)
-                    R = np.eye(3)
-                    
-                    # 平移向量
-                    t = np.array([cam_x, cam_y, cam_z])
-                    
-                    # 投影到影像
-                    proj = project_voxel_to_image(voxel_3d, K, R, t)
-                    
-                    if proj is None:
-                        visible_in_all = False
-                        break
-                    
-                    px, py = proj
-                    
-                    # 檢查投影點是否在影像範圍內
-                    if not (0 <= px < w and 0 <= py < h):
-                        visible_in_all = False
-                        break
-                    
-                    # 檢查投影點是否在輪廓內
-                    if silhouettes[angle_idx][py, px] == 0:  # 0 = 背景
-                        visible_in_all = False
-                        break
-                
-                if not visible_in_all:
-                    voxel_grid[z, y, x] = 0
-                    carving_count += 1
+    # 所有體素的 3D 座標 (正規化)，依 (z, y, x) 順序攤平成 (M, 3) 的 (x, y, z)
+    depth, height, width = voxel_grid.shape
+    xs = (np.arange(width) - voxel_res / 2) / (voxel_res / 2)
+    ys = (np.arange(height) - voxel_res / 4) / (voxel_res / 4)
+    zs = (np.arange(depth) - voxel_res / 2) / (voxel_res / 2)
+    gz, gy, gx = np.meshgrid(zs, ys, xs, indexing='ij')
+    # 投影只需要 float32 精度：體素座標與投影矩陣都用 float32，記憶體頻寬減半
+    voxels = np.stack([gx.ravel(), gy.ravel(), gz.ravel()], axis=1).astype(np.float32)
     
+    P = projection_matrices(K, angles, radius)
+    if device == 'cuda' and cp is None:
+        print("⚠ 未安裝 CuPy，改用 CPU 雕刻")
+        device = 'cpu'
+    if device == 'cuda':
+        active = carve_voxels_cuda(voxels, P, silhouettes)
+    else:
+        active = carve_voxels_cpu(xs, ys, zs, voxels, P, silhouettes)
+    
+    voxel_grid[...] = 0
+    voxel_grid.reshape(-1)[active] = 1
+    carving_count = len(voxels) - len(active)
     print(f"\n✓ 雕刻完成: 移除 {carving_count} 個體素")
     
     return voxel_grid, silhouettes
 
 def extract_point_cloud(voxel_grid, voxel_size=0.02):
-    """從體素網格提取點雲"""
-    points = []
-    
-    for z in range(voxel_grid.shape[0]):
-        for y in range(voxel_grid.shape[1]):
-            for x in range(voxel_grid.shape[2]):
-                if voxel_grid[z, y, x] > 0:
-                    # 轉換為世界座標
-                    world_x = (x - voxel_grid.shape[2] / 2) * voxel_size
-                    world_y = (y - voxel_grid.shape[1] / 2) * voxel_size
-                    world_z = (z - voxel_grid.shape[0] / 2) * voxel_size
-                    points.append([world_x, world_y, world_z])
-    
-    return np.array(points, dtype=np.float32)
+    """從體素網格提取點雲（依 z, y, x 順序）"""
+    # 非零體素的 (z, y, x) 索引，反轉成 (x, y, z) 後轉換為世界座標
+    zyx = np.argwhere(voxel_grid > 0)
+    center = np.array(voxel_grid.shape[::-1]) / 2
+    points = (zyx[:, ::-1] - center) * voxel_size
+    return points.astype(np.float32)
 
 def save_ply(points, filename="result.ply"):
-    """保存為 PLY 格式"""
-    ply_header = f"""ply
-format ascii 1.0
-element vertex {len(points)}
-property float x
-property float y
-property float z
-end_header
-"""
-    
-    with open(filename, 'w') as f:
-        f.write(ply_header)
-        for p in points:
-            f.write(f"{p[0]:.6f} {p[1]:.6f} {p[2]:.6f}\n")
-    
+    """保存為 PLY 格式（二進位，見 ply_io.write_ply）"""
+    write_ply(filename, points)
     print(f"✓ 已保存: {filename}")
 
+def show_silhouette(ax, silhouettes):
+    """在 ax 顯示第一張影像的輪廓"""
+    ax.imshow(silhouettes[0], cmap='gray')
+    ax.set_title(f'輪廓提取 (影像 1/{len(silhouettes)})')
+    ax.axis('off')
+
 def visualize_3d(points, silhouettes=None):
-    """可視化 3D 點雲"""
+    """
+    可視化 3D 點雲（已安裝 pyvista / open3d 時改用 view_ply 的 OpenGL 視窗）
+    OpenGL 視窗只畫點雲，輪廓另開一個 Matplotlib 視窗同時顯示
+    """
+    if len(points) > 0 and (view_ply.pv is not None or view_ply.o3d is not None):
+        if silhouettes:
+            fig, ax = plt.subplots(figsize=(7, 5))
+            show_silhouette(ax, silhouettes)
+            plt.tight_layout()
+            # 不阻塞：先畫出輪廓視窗，再開啟 OpenGL 視窗
+            plt.show(block=False)
+            plt.pause(0.001)
+        if view_ply.pv is not None:
+            view_ply.visualize_pyvista(points)
+        else:
+            view_ply.visualize_open3d(points)
+        # OpenGL 視窗關閉後，輪廓視窗仍保留到使用者關閉為止
+        plt.show()
+        return
+    
     fig = plt.figure(figsize=(14, 5))
     
     # 3D 點雲
@@ -227,11 +305,11 @@ def visualize_3d(points, silhouettes=None):
         # 嘗試計算 ConvexHull
         try:
             if len(points) >= 4:
-                hull = ConvexHull(points)
-                hull_points = points[hull.vertices]
-                ax1.plot_trisurf(hull_points[:, 0], hull_points[:, 1], hull_points[:, 2],
-                               triangles=hull.simplices, alpha=0.1, edgecolor='red', linewidth=0.5)
-                print(f"✓ ConvexHull: {len(hull.simplices)} 三角形, 體積={hull.volume:.6f}")
+                verts, simplices, volume = hull_mesh(points)
+                # 所有三角形合成單一 Poly3DCollection，一次繪製
+                ax1.add_collection3d(Poly3DCollection(
+                    verts[simplices], alpha=0.1, edgecolor='red', linewidth=0.5))
+                print(f"✓ ConvexHull: {len(simplices)} 三角形, 體積={volume:.6f}")
         except Exception as e:
             print(f"⚠ ConvexHull 計算失敗: {e}")
     
@@ -243,11 +321,7 @@ def visualize_3d(points, silhouettes=None):
     
     # 輪廓顯示
     if silhouettes:
-        ax2 = fig.add_subplot(122)
-        # 顯示第一張影像的輪廓
-        ax2.imshow(silhouettes[0], cmap='gray')
-        ax2.set_title(f'輪廓提取 (影像 1/8)')
-        ax2.axis('off')
+        show_silhouette(fig.add_subplot(122), silhouettes)
     
     plt.tight_layout()
     plt.show()
@@ -257,6 +331,13 @@ def main():
     print("🔬 8 張影像 3D 重建系統")
     print("=" * 60)
     
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='8 張影像 3D 重建')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='體素雕刻使用的裝置 (cuda 需安裝 CuPy，預設: cpu)')
+    args = parser.parse_args()
+    
     # 載入影像
     images = load_images("scan_images")
     if not images:
@@ -267,7 +348,8 @@ def main():
     voxel_grid, silhouettes = carve_voxels_simple(
         images, 
         voxel_res=32,  # 32×16×32 體素
-        num_angles=8
+        num_angles=8,
+        device=args.device
     )
     
     # 提取點雲
@@ -6,10 +6,15 @@
 
 import cv2
 import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from scipy.spatial import ConvexHull
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+
+from hull_utils import hull_mesh
+from ply_io import write_ply
 
 def load_images(scan_dir="scan_images", num_images=8):
     """載入掃描影像"""
@@ -30,6 +35,7 @@ def load_images(scan_dir="scan_images", num_images=8):
 def extract_silhouette_adaptive(img):
     """
     自適應輪廓提取 - 尋找最暗的前景
+    取 Otsu 二值化後面積最大的外輪廓並填滿，一次得到無孔洞、無雜點的輪廓
     """
     # 轉灰度
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -37,20 +43,19 @@ def extract_silhouette_adaptive(img):
     # Otsu 自適應閾值
     _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     
-    # 形態學操作
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel, iterations=2)
-    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=1)
-    
-    # 填充孔洞
-    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel, iterations=3)
+    # 只保留最大的外輪廓並填滿（取代多次開/閉運算的降噪與補洞）
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    mask = np.zeros_like(binary)
+    if contours:
+        largest = max(contours, key=cv2.contourArea)
+        cv2.drawContours(mask, [largest], -1, 255, thickness=cv2.FILLED)
     
-    return binary
+    return mask
 
 def get_foreground_pixels(silhouette):
-    """取得前景像素座標集合"""
+    """取得前景像素座標，(K, 2) 陣列，每列為 (x, y)"""
     y, x = np.where(silhouette > 128)
-    return set(zip(x, y))
+    return np.column_stack((x, y))
 
 def reconstruct_from_silhouettes(images, grid_size=40):
     """
@@ -65,10 +70,10 @@ def reconstruct_from_silhouettes(images, grid_size=40):
     
     # 提取輪廓
     print(f"\n🎯 提取輪廓中...")
-    silhouettes = []
-    for i, img in enumerate(images):
-        sil = extract_silhouette_adaptive(img)
-        silhouettes.append(sil)
+    # OpenCV 運算會釋放 GIL，各影像的輪廓以執行緒平行提取
+    with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as ex:
+        silhouettes = list(ex.map(extract_silhouette_adaptive, images))
+    for i, sil in enumerate(silhouettes):
         fg_pixels = len(np.where(sil > 0)[0])
         print(f"  影像 {i+1}: {fg_pixels} 前景像素")
     
@@ -79,57 +84,35 @@ def reconstruct_from_silhouettes(images, grid_size=40):
     y_range = np.linspace(0, h, grid_size)
     z_range = np.linspace(-1.0, 1.0, grid_size)  # 深度 (假設的 z 軸)
     
-    points = []
-    num_cameras = len(images)
+    # 像素座標只與 x、y 有關：每軸四捨五入一次（np.rint 與 np.round 同為四捨六入五成雙）
+    px_range = np.rint(x_range).astype(int)
+    py_range = np.rint(y_range).astype(int)
     
     print(f"\n🔄 視覺殼層交集中...")
-    total = grid_size ** 3
-    
-    for iz, z in enumerate(z_range):
-        for iy, y in enumerate(y_range):
-            for ix, x in enumerate(x_range):
-                if (iz * grid_size * grid_size + iy * grid_size + ix) % 5000 == 0:
-                    progress = 100 * (iz * grid_size * grid_size + iy * grid_size + ix) / total
-                    print(f"  進度: {progress:.1f}%", end='\r')
-                
-                px, py = int(np.round(x)), int(np.round(y))
-                
-                # 檢查邊界
-                if not (0 <= px < w and 0 <= py < h):
-                    continue
-                
-                # 檢查此像素是否在所有輪廓內
-                in_all_silhouettes = True
-                for sil in silhouettes:
-                    if sil[py, px] < 128:
-                        in_all_silhouettes = False
-                        break
-                
-                if in_all_silhouettes:
-                    # 將 2D 像素 + 深度 z 映射到 3D
-                    # 正規化座標
-                    x_norm = (x - w / 2) / w
-                    y_norm = (y - h / 2) / h
-                    
-                    points.append([x_norm, y_norm, z])
+    
+    # 判斷只看 (px, py) 是否在所有輪廓內，與 z 無關：
+    # 先把所有輪廓 AND 成一張 2D 遮罩，在 (y, x) 網格上查一次即可
+    in_all = np.logical_and.reduce([sil >= 128 for sil in silhouettes])
+    valid_x = (px_range >= 0) & (px_range < w)
+    valid_y = (py_range >= 0) & (py_range < h)
+    keep_xy = (in_all[np.clip(py_range, 0, h - 1)[:, None], np.clip(px_range, 0, w - 1)[None, :]]
+               & valid_y[:, None] & valid_x[None, :])
+    print("  進度: 100.0%", end='\r')
+    
+    # 將 2D 像素 + 深度 z 映射到 3D（正規化座標）；點的順序同 z、y、x 三層迴圈
+    iy, ix = np.nonzero(keep_xy)
+    x_norm = (x_range[ix] - w / 2) / w
+    y_norm = (y_range[iy] - h / 2) / h
+    points = np.column_stack((np.tile(x_norm, grid_size),
+                              np.tile(y_norm, grid_size),
+                              np.repeat(z_range, len(ix)))).astype(np.float32)
     
     print(f"\n✓ 重建完成: {len(points)} 個點")
-    return np.array(points, dtype=np.float32)
+    return points
 
 def save_ply(points, filename="result.ply"):
-    """保存為 PLY 格式"""
-    with open(filename, 'w') as f:
-        f.write(f"ply\n")
-        f.write(f"format ascii 1.0\n")
-        f.write(f"element vertex {len(points)}\n")
-        f.write(f"property float x\n")
-        f.write(f"property float y\n")
-        f.write(f"property float z\n")
-        f.write(f"end_header\n")
-        
-        for p in points:
-            f.write(f"{p[0]:.6f} {p[1]:.6f} {p[2]:.6f}\n")
-    
+    """保存為 PLY 格式（二進位，見 ply_io.write_ply）"""
+    write_ply(filename, points)
     print(f"✓ 已保存: {filename}")
 
 def visualize_results(images, silhouettes, points):
@@ -144,10 +127,11 @@ def visualize_results(images, silhouettes, points):
         # 嘗試計算 ConvexHull 並以半透明表面顯示
         try:
             if len(points) >= 4:
-                hull = ConvexHull(points)
-                ax.plot_trisurf(points[:, 0], points[:, 1], points[:, 2],
-                                triangles=hull.simplices, alpha=0.12, edgecolor='red', linewidth=0.2)
-                print(f"\n✓ ConvexHull: {len(hull.simplices)} 三角形, 體積={hull.volume:.6f}")
+                verts, simplices, volume = hull_mesh(points)
+                # 所有三角形合成單一 Poly3DCollection，一次繪製
+                ax.add_collection3d(Poly3DCollection(
+                    verts[simplices], alpha=0.12, edgecolor='red', linewidth=0.2))
+                print(f"\n✓ ConvexHull: {len(simplices)} 三角形, 體積={volume:.6f}")
         except Exception:
             pass
 
@@ -158,6 +142,33 @@ def visualize_results(images, silhouettes, points):
     plt.tight_layout()
     plt.show()
 
+def rebuild(output, grid_size=40, num_images=8, scan_dir="scan_images"):
+    """
+    載入影像、重建並寫出 PLY（不開視窗），供 build_ply 在同一程序內呼叫
+    回傳 (images, points)；沒有影像或沒有點時回傳 None，不寫檔
+    """
+    # 載入
+    images = load_images(scan_dir, num_images=num_images)
+    if not images:
+        return None
+    
+    # 重建
+    points = reconstruct_from_silhouettes(images, grid_size=grid_size)
+    if len(points) == 0:
+        print("❌ 無法提取點雲")
+        return None
+    
+    # 統計
+    print(f"\n📊 統計:")
+    print(f"  點數: {len(points)}")
+    print(f"  X 範圍: [{points[:, 0].min():.3f}, {points[:, 0].max():.3f}]")
+    print(f"  Y 範圍: [{points[:, 1].min():.3f}, {points[:, 1].max():.3f}]")
+    print(f"  Z 範圍: [{points[:, 2].min():.3f}, {points[:, 2].max():.3f}]")
+    
+    # 保存
+    save_ply(points, output)
+    return images, points
+
 def main():
     print("=" * 70)
     print("🎬 改進版視覺殼層 3D 重建")
@@ -168,33 +179,22 @@ def main():
     parser = argparse.ArgumentParser(description='改進版視覺殼層 3D 重建')
     parser.add_argument('--grid_size', type=int, default=40, help='3D 網格解析度 (預設: 40)')
     parser.add_argument('--num_images', type=int, default=8, help='使用的影像數量 (預設: 8)')
+    parser.add_argument('--output', default='scan_images/result_visual_hull.ply', help='輸出 PLY 路徑')
+    parser.add_argument('--no_display', action='store_true', help='只輸出 PLY，不開啟 3D 視窗')
     args = parser.parse_args()
 
-    # 載入
-    images = load_images("scan_images", num_images=args.num_images)
-    if not images:
+    result = rebuild(args.output, grid_size=args.grid_size, num_images=args.num_images)
+    if result is None:
+        # 沒有寫出 PLY：以非零結束碼讓呼叫端 (build_ply) 知道重建失敗
+        raise SystemExit(1)
+    if args.no_display:
         return
+    images, points = result
     
-    # 重建
-    points = reconstruct_from_silhouettes(images, grid_size=args.grid_size)
-    
-    if len(points) > 0:
-        # 統計
-        print(f"\n📊 統計:")
-        print(f"  點數: {len(points)}")
-        print(f"  X 範圍: [{points[:, 0].min():.3f}, {points[:, 0].max():.3f}]")
-        print(f"  Y 範圍: [{points[:, 1].min():.3f}, {points[:, 1].max():.3f}]")
-        print(f"  Z 範圍: [{points[:, 2].min():.3f}, {points[:, 2].max():.3f}]")
-        
-        # 保存
-        save_ply(points, "scan_images/result_visual_hull.ply")
-        
-        # 可視化
-        print("\n📊 顯示 3D 視窗...")
-        silhouettes = [extract_silhouette_adaptive(img) for img in images]
-        visualize_results(images, silhouettes, points)
-    else:
-        print("❌ 無法提取點雲")
+    # 可視化
+    print("\n📊 顯示 3D 視窗...")
+    silhouettes = [extract_silhouette_adaptive(img) for img in images]
+    visualize_results(images, silhouettes, points)
 
 if __name__ == "__main__":
     main()
@@ -6,12 +6,24 @@
 
 import cv2
 import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from scipy.spatial import ConvexHull
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 from tqdm import tqdm
 
+# 選用：安裝 CuPy 時可用 --device cuda 在 GPU 上雕刻
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+from carver import carve
+from ply_io import write_ply
+
 def load_images(scan_dir="scan_images", num_images=8):
     """載入掃描影像"""
     images = []
@@ -55,61 +67,145 @@ def extract_silhouette(img, threshold=120, use_hsv=True):
     
     return binary
 
-def get_silhouette_mask(silhouette, img_w, img_h):
-    """從二值圖像獲取輪廓像素集合"""
-    y_coords, x_coords = np.where(silhouette > 0)
-    if len(x_coords) == 0:
-        return set()
-    return set(zip(x_coords, y_coords))
+def camera_positions(num_cameras=8, radius=2.0):
+    """
+    相機位置 (num_cameras, 3)
+    簡化假設: 相機在 y = 0 平面上圍繞 Y 軸等角度排列
+    """
+    angles = 2 * np.pi * np.arange(num_cameras) / num_cameras
+    cams = np.zeros((num_cameras, 3))
+    cams[:, 0] = radius * np.cos(angles)
+    cams[:, 2] = radius * np.sin(angles)
+    return cams
 
-def project_3d_to_2d(point_3d, angle_idx, num_cameras=8, radius=2.0, focal_length=400):
+def project_3d_to_2d(points_3d, cam_pos, focal_length=400, scale=1.0):
     """
-    將 3D 點投影到 2D 影像
-    簡化假設: 相機圍繞物體圓周排列
+    將 (N, 3) 個 3D 點一次投影到位於 cam_pos 的相機影像
+    scale: 影像縮放倍率，焦距與影像中心一併縮放
+    回傳 (px, py, valid)：int32 像素座標與深度有效遮罩 (z 深度 >= 0.1)
     """
-    angle = 2 * np.pi * angle_idx / num_cameras
+    # 從點到相機的向量；只取投影用到的分量，不建立 (N, 3) 暫存
+    # 旋轉使相機看向原點 (簡化: 直接投影)
+    p_x = points_3d[:, 0] - cam_pos[0]
+    p_y = points_3d[:, 1] - cam_pos[1]
+    p_z = points_3d[:, 2] - cam_pos[2]
     
-    # 相機位置 (圍繞 Y 軸)
-    cam_x = radius * np.cos(angle)
-    cam_z = radius * np.sin(angle)
-    cam_y = 0
+    # z 深度；過近或在相機後方的點無效，以 1 代入避免除以零
+    valid = p_z >= 0.1
+    p_z = np.where(valid, p_z, 1.0)
     
-    # 從點到相機的向量
-    p = point_3d - np.array([cam_x, cam_y, cam_z])
+    # 透視投影；astype 與 int() 同為向零截斷
+    img_x = focal_length * scale * p_x / p_z + 223 * scale  # 中心 446/2
+    img_y = focal_length * scale * p_y / p_z + 195 * scale  # 中心 391/2
     
-    # 旋轉使相機看向原點 (簡化: 直接投影)
-    # z 深度
-    if p[2] < 0.1:
-        return None
+    return img_x.astype(np.int32), img_y.astype(np.int32), valid
+
+def coarse_carve(x_range, y_range, z_range, cams, silhouettes, scale=1.0, block=4):
+    """
+    粗略雕刻：以 block³ 個體素為一塊，整塊在某視角一定落在背景時一次移除
+    回傳 (len(x_range), len(y_range), len(z_range)) 的布林遮罩，True 為仍需逐體素檢查者
+
+    投影的每一步（減法、乘除、int 截斷）都對 x、y、z 單調，區塊內體素的像素座標
+    必落在 8 個角點（最外側體素中心）投影的外接矩形內；以同一個 project_3d_to_2d
+    計算角點，矩形是精確的。矩形內沒有前景像素（以積分影像查詢）就保證整塊都會被雕刻掉。
+    各視角影像尺寸可能不同，積分影像與矩形裁切都以該視角自己的 (h, w) 計算。
+    """
+    # 每塊在各軸上的第一個與最後一個體素座標
+    lo_hi = []
+    for c in (x_range, y_range, z_range):
+        starts = np.arange(0, len(c), block)
+        ends = np.minimum(starts + block, len(c)) - 1
+        lo_hi.append(np.stack([c[starts], c[ends]], axis=1))
+    (bx, by, bz) = lo_hi
+    nx, ny, nz = len(bx), len(by), len(bz)
+    # 角點 (nx, ny, nz, 8, 3)
+    corners = np.empty((nx, ny, nz, 8, 3))
+    for k in range(8):
+        corners[..., k, 0] = bx[:, None, None, k & 1]
+        corners[..., k, 1] = by[None, :, None, (k >> 1) & 1]
+        corners[..., k, 2] = bz[None, None, :, (k >> 2) & 1]
+    corners = corners.reshape(-1, 3)
     
-    # 透視投影
-    img_x = focal_length * p[0] / p[2] + 223  # 中心 446/2
-    img_y = focal_length * p[1] / p[2] + 195  # 中心 391/2
+    alive = np.ones(nx * ny * nz, dtype=bool)
+    for cam, sil in zip(cams, silhouettes):
+        h, w = sil.shape[:2]
+        # 積分影像：sat[v, u] 為 sil[:v, :u] 的前景像素數
+        sat = np.zeros((h + 1, w + 1), dtype=np.int64)
+        sat[1:, 1:] = np.cumsum(np.cumsum(sil != 0, axis=0), axis=1)
+        px, py, valid = project_3d_to_2d(corners, cam, scale=scale)
+        px, py, valid = px.reshape(-1, 8), py.reshape(-1, 8), valid.reshape(-1, 8)
+        # 有角點深度無效的區塊保守地保留，交給逐體素檢查；外接矩形裁切到影像範圍
+        u0 = np.maximum(px.min(axis=1), 0)
+        u1 = np.minimum(px.max(axis=1), w - 1)
+        v0 = np.maximum(py.min(axis=1), 0)
+        v1 = np.minimum(py.max(axis=1), h - 1)
+        empty = (u0 > u1) | (v0 > v1)
+        u0, u1 = np.minimum(u0, w - 1), np.maximum(u1, 0)
+        v0, v1 = np.minimum(v0, h - 1), np.maximum(v1, 0)
+        fg = sat[v1 + 1, u1 + 1] - sat[v0, u1 + 1] - sat[v1 + 1, u0] + sat[v0, u0]
+        alive &= ~(valid.all(axis=1) & (empty | (fg == 0)))
     
-    return int(img_x), int(img_y)
+    alive = alive.reshape(nx, ny, nz)
+    ix = np.arange(len(x_range)) // block
+    iy = np.arange(len(y_range)) // block
+    iz = np.arange(len(z_range)) // block
+    return alive[np.ix_(ix, iy, iz)]
+
+def carve_voxels_cpu(x_range, y_range, z_range, voxels, cams, silhouettes, scale=1.0):
+    """CPU 雕刻：區塊粗略雕刻後逐相機檢查剩餘體素（見 carver.carve），回傳保留體素的索引"""
+    # 先以區塊粗略雕刻，只有未被整塊移除的體素才逐一投影
+    active = np.flatnonzero(coarse_carve(x_range, y_range, z_range, cams, silhouettes, scale))
+    return carve(voxels, silhouettes[:len(cams)],
+                 lambda pts, k: project_3d_to_2d(pts, cams[k], scale=scale), active=active)
 
-def reconstruct_visual_hull(images, voxel_res=48, num_cameras=8):
+def carve_voxels_cuda(voxels, cams, silhouettes, scale=1.0, focal_length=400):
+    """
+    以 CuPy 在 GPU 上對所有體素計算每個相機的投影與輪廓查詢
+    判斷規則與 CPU 版 (project_3d_to_2d) 相同，影像範圍以各視角輪廓自己的 (h, w) 判斷；
+    回傳保留體素的索引（NumPy 陣列）
+    """
+    V = cp.asarray(voxels)
+    keep = cp.ones(len(V), dtype=bool)
+    for cam, sil in zip(cams, silhouettes):
+        sil = cp.asarray(sil)
+        h, w = sil.shape[:2]
+        p_z = V[:, 2] - cam[2]
+        valid = p_z >= 0.1
+        p_z = cp.where(valid, p_z, 1.0)
+        px = (focal_length * scale * (V[:, 0] - cam[0]) / p_z + 223 * scale).astype(cp.int32)
+        py = (focal_length * scale * (V[:, 1] - cam[1]) / p_z + 195 * scale).astype(cp.int32)
+        valid &= (px >= 0) & (px < w) & (py >= 0) & (py < h)
+        px = cp.where(valid, px, 0)
+        py = cp.where(valid, py, 0)
+        keep &= valid & (sil[py, px] > 0)
+    return cp.asnumpy(cp.flatnonzero(keep))
+
+def reconstruct_visual_hull(images, voxel_res=48, num_cameras=8, device='cpu', scale=1.0):
     """
     視覺殼層重建
     體素必須在所有相機視角的輪廓內才能保留
+    device='cuda' 且已安裝 CuPy 時改在 GPU 上計算
+    scale < 1 時先縮小影像再提取輪廓（例如 0.35），輪廓像素只需精確到一個體素的投影大小
+    回傳 (points, silhouettes)，輪廓可直接交給 visualize_3d，不必再提取一次
     """
     if not images:
-        return np.array([])
+        return np.array([]), []
     
     h, w = images[0].shape[:2]
     print(f"📐 影像解析度: {w}×{h}")
     
     # 提取所有輪廓
     print(f"\n🎯 提取 {len(images)} 個輪廓中...")
-    silhouettes = []
-    masks = []
+    # OpenCV 運算會釋放 GIL，各影像的輪廓以執行緒平行提取；
+    # 各影像尺寸不一定相同，輪廓保持 list，各視角以自己的尺寸判斷範圍
+    with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as ex:
+        if scale != 1.0:
+            images = list(ex.map(lambda img: cv2.resize(img, None, fx=scale, fy=scale,
+                                                        interpolation=cv2.INTER_AREA), images))
+        silhouettes = list(ex.map(extract_silhouette, images))
     
-    for i, img in enumerate(images):
-        sil = extract_silhouette(img)
-        silhouettes.append(sil)
-        mask = get_silhouette_mask(sil, w, h)
-        masks.append(mask)
-        print(f"  影像 {i+1}: {len(mask)} 像素")
+    for i, sil in enumerate(silhouettes):
+        print(f"  影像 {i+1}: {np.count_nonzero(sil)} 像素")
     
     # 建立體素網格
     print(f"\n🔲 建立體素網格 {voxel_res}³...")
@@ -119,66 +215,36 @@ def reconstruct_visual_hull(images, voxel_res=48, num_cameras=8):
     y_range = np.linspace(-0.5, 1.0, voxel_res // 2)
     z_range = np.linspace(-1.5, 1.5, voxel_res)
     
-    points = []
+    # 相機位置與視角無關，只算一次
+    cams = camera_positions(num_cameras)
+    
+    # 深度測試 (z - cam_z >= 0.1) 只與 z 有關：先剔除在任一相機深度無效的 z 層，
+    # 這些體素不論 x、y 都會被移除，不必建立與投影
+    depth_ok = np.all(z_range[:, None] - cams[:, 2] >= 0.1, axis=1)
+    z_range = z_range[depth_ok]
+    
+    # 所有體素中心 (N, 3)，順序同 x、y、z 三層迴圈
+    X, Y, Z = np.meshgrid(x_range, y_range, z_range, indexing='ij')
+    voxels = np.stack((X, Y, Z), axis=-1).reshape(-1, 3)
     
     print(f"\n🔄 視覺殼層雕刻中...")
-    total_voxels = len(x_range) * len(y_range) * len(z_range)
-    processed = 0
     
-    for ix, x in enumerate(x_range):
-        for iy, y in enumerate(y_range):
-            for iz, z in enumerate(z_range):
-                processed += 1
-                if processed % 10000 == 0:
-                    print(f"  進度: {processed}/{total_voxels} ({100*processed/total_voxels:.1f}%)", end='\r')
-                
-                point_3d = np.array([x, y, z])
-                
-                # 檢查此點在所有相機視角是否可見
-                visible_in_all = True
-                
-                for cam_idx in range(num_cameras):
-                    proj = project_3d_to_2d(point_3d, cam_idx, num_cameras)
-                    
-                    if proj is None:
-                        visible_in_all = False
-                        break
-                    
-                    px, py = proj
-                    
-                    # 檢查投影是否在影像範圍內
-                    if not (0 <= px < w and 0 <= py < h):
-                        visible_in_all = False
-                        break
-                    
-                    # 檢查投影是否在輪廓內
-                    if (px, py) not in masks[cam_idx]:
-                        visible_in_all = False
-                        break
-                
-                if visible_in_all:
-                    points.append(point_3d)
+    if device == 'cuda' and cp is None:
+        print("⚠ 未安裝 CuPy，改用 CPU 雕刻")
+        device = 'cpu'
+    if device == 'cuda':
+        active = carve_voxels_cuda(voxels, cams, silhouettes, scale)
+    else:
+        active = carve_voxels_cpu(x_range, y_range, z_range, voxels, cams, silhouettes, scale)
     
+    points = voxels[active].astype(np.float32)
     print(f"\n✓ 雕刻完成: 保留 {len(points)} 個體素")
     
-    return np.array(points, dtype=np.float32)
+    return points, silhouettes
 
 def save_ply(points, filename="result.ply"):
-    """保存為 PLY 格式"""
-    ply_header = f"""ply
-format ascii 1.0
-element vertex {len(points)}
-property float x
-property float y
-property float z
-end_header
-"""
-    
-    with open(filename, 'w') as f:
-        f.write(ply_header)
-        for p in points:
-            f.write(f"{p[0]:.6f} {p[1]:.6f} {p[2]:.6f}\n")
-    
+    """保存為 PLY 格式（二進位，見 ply_io.write_ply）"""
+    write_ply(filename, points)
     print(f"✓ 已保存: {filename} ({len(points)} 點)")
 
 def visualize_3d(points, silhouettes):
@@ -195,10 +261,9 @@ def visualize_3d(points, silhouettes):
         try:
             if len(points) >= 4:
                 hull = ConvexHull(points)
-                for simplex in hull.simplices:
-                    triangle = points[simplex]
-                    ax1.plot_trisurf(triangle[:, 0], triangle[:, 1], triangle[:, 2],
-                                   alpha=0.1, edgecolor='red', linewidth=0.3)
+                # 所有三角形合成單一 Poly3DCollection，一次繪製
+                ax1.add_collection3d(Poly3DCollection(
+                    points[hull.simplices], alpha=0.1, edgecolor='red', linewidth=0.3))
                 print(f"✓ ConvexHull: {len(hull.simplices)} 三角形, 體積={hull.volume:.6f}")
         except Exception as e:
             print(f"⚠ ConvexHull 計算失敗: {e}")
@@ -229,6 +294,15 @@ def main():
     print("🎬 視覺殼層 (Visual Hull) 3D 重建")
     print("=" * 70)
     
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='視覺殼層 (Visual Hull) 3D 重建')
+    parser.add_argument('--device', choices=['cpu', 'cuda'], default='cpu',
+                        help='體素雕刻使用的裝置 (cuda 需安裝 CuPy，預設: cpu)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='提取輪廓前的影像縮放倍率，例如 0.35 (預設: 1.0 不縮放)')
+    args = parser.parse_args()
+    
     # 載入影像
     images = load_images("scan_images", num_images=8)
     if not images:
@@ -236,7 +310,8 @@ def main():
         return
     
     # 重建
-    points = reconstruct_visual_hull(images, voxel_res=48, num_cameras=8)
+    points, silhouettes = reconstruct_visual_hull(images, voxel_res=48, num_cameras=8,
+                                                  device=args.device, scale=args.scale)
     
     # 顯示統計
     if len(points) > 0:
@@ -252,7 +327,6 @@ def main():
         
         # 可視化
         print("\n📊 顯示 3D 視窗...")
-        silhouettes = [extract_silhouette(img) for img in images]
         visualize_3d(points, silhouettes)
     else:
         print("❌ 無法提取點雲")
@@ -30,6 +30,7 @@ try:
     import matplotlib
     import matplotlib.pyplot as plt
     from mpl_toolkits.mplot3d import Axes3D
+    from mpl_toolkits.mplot3d.art3d import Line3DCollection
 except ImportError:
     missing.append('matplotlib')
 try:
@@ -48,6 +49,10 @@ import time
 import os
 import argparse
 import math
+from concurrent.futures import ThreadPoolExecutor
+
+from carver import carve, view_order
+from ply_io import file_key, load_ply, write_ply
 
 # ---------- CONFIG ----------
 ESP32_IP = "192.168.1.100"   # <<--- 改成你的 ESP32-CAM IP
@@ -73,10 +78,12 @@ def send_rotate(ser, steps):
             print("Arduino error:", line)
             return False
 
-def capture_image(esp_ip, save_path, timeout=10, simulate=False, sim_idx=0, sim_total=36):
+def capture_image(esp_ip, save_path, timeout=10, simulate=False, sim_idx=0, sim_total=36, session=None):
     """
     If simulate==False: perform HTTP GET to ESP32 and save JPEG.
     If simulate==True: generate a synthetic image and save to `save_path`.
+    session: optional requests.Session to issue the GET through (the call is the same either way;
+             esp32cam_capture.ino closes the connection after every reply, so nothing is reused).
     """
     if simulate:
         # dispatch to shape-specific simulator (default ellipse for backward compatibility)
@@ -105,7 +112,7 @@ def capture_image(esp_ip, save_path, timeout=10, simulate=False, sim_idx=0, sim_
 
     url = f"http://{esp_ip}/capture"
     try:
-        r = requests.get(url, timeout=timeout)
+        r = (session or requests).get(url, timeout=timeout)
         if r.status_code == 200 and 'image' in r.headers.get('Content-Type',''):
             with open(save_path, 'wb') as f:
                 f.write(r.content)
@@ -159,7 +166,7 @@ class MockSerial:
 
 def project_points(points_world, cam_pos, cam_target, img_w, img_h, f=800.0):
     """Project 3D points (Nx3) to image plane using simple pinhole camera.
-    cam_pos, cam_target: 3D positions. Returns list of 2D points (u,v) and bool mask for in-front.
+    cam_pos, cam_target: 3D positions. Returns (N,2) int array of 2D points (u,v) and bool mask for in-front.
     """
     # build camera basis
     forward = (cam_target - cam_pos)
@@ -173,20 +180,17 @@ def project_points(points_world, cam_pos, cam_target, img_w, img_h, f=800.0):
     true_up = np.cross(right, forward)
     R = np.vstack((right, true_up, forward))  # 3x3
     pts_cam = (R @ (points_world - cam_pos).T).T
-    uv = []
-    mask = []
     cx, cy = img_w / 2.0, img_h / 2.0
-    for p in pts_cam:
-        X, Y, Z = p[0], p[1], p[2]
-        if Z <= 1e-6:
-            mask.append(False)
-            uv.append((0,0))
-            continue
-        u = f * (X / Z) + cx
-        v = f * (Y / Z) + cy
-        uv.append((int(round(u)), int(round(v))))
-        mask.append(True)
-    return uv, np.array(mask, dtype=bool)
+    Z = pts_cam[:, 2]
+    mask = Z > 1e-6
+    # points behind the camera get (0, 0); divide by 1 there to avoid inf/nan
+    Zs = np.where(mask, Z, 1.0)
+    u = f * (pts_cam[:, 0] / Zs) + cx
+    v = f * (pts_cam[:, 1] / Zs) + cy
+    # np.rint rounds half to even, like the built-in round()
+    uv = np.rint(np.column_stack((u, v))).astype(np.int64)
+    uv[~mask] = 0
+    return uv, mask
 
 
 def simulate_pyramid_image(save_path, sim_idx, sim_total, per_ring, rings, radius, apex_h, elev_step=15.0):
@@ -228,7 +232,7 @@ def simulate_pyramid_image(save_path, sim_idx, sim_total, per_ring, rings, radiu
     # project vertices
     img_w, img_h = 800, 600
     uv, mask = project_points(vertices, cam_pos, cam_target, img_w, img_h, f=800.0)
-    pts2 = np.array([p for p,m in zip(uv, mask) if m], dtype=np.int32)
+    pts2 = uv[mask].astype(np.int32)
     img = np.zeros((img_h, img_w, 3), dtype=np.uint8)
     if pts2.shape[0] >= 3:
         # convex hull of projected points gives silhouette
@@ -265,74 +269,157 @@ def extract_silhouette(img_path):
     th = cv2.morphologyEx(th, cv2.MORPH_CLOSE, kernel)
     return th
 
+# Silhouettes of a capture are cached next to the images, keyed by each file's path/mtime/size,
+# so re-running the carving (e.g. at another voxel_res) or the viewer skips decode + morphology
+SIL_CACHE = '.silhouettes_cache.npz'
+
+def _silhouette_cache(image_files):
+    path = os.path.join(os.path.dirname(image_files[0]), SIL_CACHE)
+    key = repr([file_key(f) for f in image_files])
+    return path, key
+
+def save_silhouette_cache(image_files, silhouettes):
+    """Store masks from extract_silhouette (same order as image_files) in the cache file."""
+    path, key = _silhouette_cache(image_files)
+    tmp = path + '.tmp.npz'
+    try:
+        sils = np.stack(silhouettes)
+        # masks are 0/255, so one bit per pixel is enough
+        np.savez(tmp, key=np.array(key), shape=np.array(sils.shape), bits=np.packbits(sils != 0))
+        os.replace(tmp, path)
+    except (OSError, ValueError) as e:
+        print('Silhouette cache not saved:', e)
+
+def load_silhouettes(image_files):
+    """Return extract_silhouette masks for image_files, reusing the cache if no image changed."""
+    if not image_files:
+        return []
+    path, key = _silhouette_cache(image_files)
+    try:
+        with np.load(path) as data:
+            if str(data['key']) == key:
+                shape = tuple(data['shape'])
+                sils = np.unpackbits(data['bits'], count=int(np.prod(shape))).reshape(shape)
+                return list(sils * np.uint8(255))
+    except (OSError, KeyError, ValueError):
+        pass
+    with ThreadPoolExecutor(max_workers=min(len(image_files), os.cpu_count() or 1)) as ex:
+        silhouettes = list(ex.map(extract_silhouette, image_files))
+    save_silhouette_cache(image_files, silhouettes)
+    return silhouettes
+
 # Naive voxel carving
-def voxel_carving(image_files, esp_ip, voxel_resolution=64, bound=0.5):
+def coarse_carve(xs, ys, zs, silhouettes, project, block=4):
+    """
+    Coarse pass: drop whole block^3 groups of voxels that some view surely carves away.
+    Returns a (len(xs), len(ys), len(zs)) bool mask, True where voxels still need the fine test.
+
+    Every voxel center of a block lies in the box spanned by its 8 outermost centers; with the
+    box in front of the camera its projection lies in the bounding rectangle of the projected
+    corners (rint is monotonic). No foreground pixel in that rectangle (summed-area table
+    lookup, widened by 1 px for float rounding) means the whole block is carved.
+    Views may differ in size; each one is clipped to its own (h, w).
+    """
+    # first and last voxel coordinate of each block along each axis
+    lo_hi = []
+    for c in (xs, ys, zs):
+        starts = np.arange(0, len(c), block)
+        ends = np.minimum(starts + block, len(c)) - 1
+        lo_hi.append(np.stack([c[starts], c[ends]], axis=1))
+    bx, by, bz = lo_hi
+    nx, ny, nz = len(bx), len(by), len(bz)
+    # corners (nx, ny, nz, 8, 3)
+    corners = np.empty((nx, ny, nz, 8, 3))
+    for k in range(8):
+        corners[..., k, 0] = bx[:, None, None, k & 1]
+        corners[..., k, 1] = by[None, :, None, (k >> 1) & 1]
+        corners[..., k, 2] = bz[None, None, :, (k >> 2) & 1]
+    corners = corners.reshape(-1, 3)
+
+    alive = np.ones(nx * ny * nz, dtype=bool)
+    for idx, sil in enumerate(silhouettes):
+        h, w = sil.shape[:2]
+        # sat[v, u] = sum of sil[:v, :u] (0/255 mask, fits int32); cv2.integral is one C pass
+        sat = cv2.integral(sil)
+        u, v, valid = project(corners, idx)
+        u, v, valid = u.reshape(-1, 8), v.reshape(-1, 8), valid.reshape(-1, 8)
+        # blocks with a corner behind the camera stay alive; the rectangle is clipped to the image
+        u0 = np.maximum(u.min(axis=1) - 1, 0)
+        u1 = np.minimum(u.max(axis=1) + 1, w - 1)
+        v0 = np.maximum(v.min(axis=1) - 1, 0)
+        v1 = np.minimum(v.max(axis=1) + 1, h - 1)
+        empty = (u0 > u1) | (v0 > v1)
+        u0, u1 = np.minimum(u0, w - 1), np.maximum(u1, 0)
+        v0, v1 = np.minimum(v0, h - 1), np.maximum(v1, 0)
+        fg = sat[v1 + 1, u1 + 1] - sat[v0, u1 + 1] - sat[v1 + 1, u0] + sat[v0, u0]
+        alive &= ~(valid.all(axis=1) & (empty | (fg == 0)))
+
+    alive = alive.reshape(nx, ny, nz)
+    ix = np.arange(len(xs)) // block
+    iy = np.arange(len(ys)) // block
+    iz = np.arange(len(zs)) // block
+    return alive[np.ix_(ix, iy, iz)]
+
+def voxel_carving(image_files, esp_ip, voxel_resolution=64, bound=0.5, silhouettes=None,
+                  on_coarse=None):
     """
     image_files: list of image file paths in order of angles (0..360)
+    silhouettes: optional list of masks already computed by extract_silhouette (same order);
+                 when omitted they come from load_silhouettes (cached next to the images)
+    on_coarse: optional callback(fraction) with the share of voxels left for the fine pass
     assumes camera on +Z axis, object at origin on turntable, camera distance and intrinsics approximated.
-    returns boolean voxel grid and point cloud list
+    returns (N,3) array of the voxel centers that survive carving
     """
+    # binary images: object white(255); extracted (or loaded from the cache) when not supplied
+    if silhouettes is None:
+        silhouettes = load_silhouettes(image_files)
     N = len(image_files)
     angles = np.linspace(0, 360, N, endpoint=False)
-    # Create voxel grid in [-bound, bound]^3
-    voxels = np.ones((voxel_resolution, voxel_resolution, voxel_resolution), dtype=bool)
+    # Create voxel grid in [-bound, bound]^3, flattened to (N,3) voxel centers in (ix, iy, iz) order
     xs = np.linspace(-bound, bound, voxel_resolution)
     ys = np.linspace(-bound, bound, voxel_resolution)
     zs = np.linspace(-bound, bound, voxel_resolution)
+    # the full (N,3) grid is needed up front: carve() projects whole batches of voxel centers per
+    # view, and the points are then gathered from it by the surviving indices
+    X, Y, Z = np.meshgrid(xs, ys, zs, indexing='ij')
+    grid = np.stack((X, Y, Z), axis=-1).reshape(-1, 3)
     # Camera approximate intrinsics
-    img0 = cv2.imdecode(np.fromfile(image_files[0], dtype=np.uint8), cv2.IMREAD_COLOR)
-    h, w = img0.shape[:2]
+    h, w = silhouettes[0].shape[:2]
     fx = fy = max(w, h)  # very rough
     cx, cy = w/2.0, h/2.0
-    # For each image, carve voxels whose projection falls outside silhouette
-    for idx, imgf in enumerate(tqdm(image_files, desc="Carving")):
-        sil = extract_silhouette(imgf)  # binary image: object white(255)
-        angle = np.deg2rad(angles[idx])
-        # camera at some distance along +Z rotated around Y by angle? We'll assume camera at (0, 0, cam_z) and turntable rotates object.
-        cam_z = 1.5  # camera distance (approx)
-        # For each voxel, project to image
-        # iterate over voxels (could be optimized)
-        for ix, x in enumerate(xs):
-            for iy, y in enumerate(ys):
-                for iz, z in enumerate(zs):
-                    if not voxels[ix,iy,iz]: 
-                        continue
-                    # rotate point by -angle around Y (object rotated relative to camera)
-                    xr = x * math.cos(-angle) + z * math.sin(-angle)
-                    yr = y
-                    zr = -x * math.sin(-angle) + z * math.cos(-angle) + cam_z  # translate camera forward
-                    if zr <= 0.001:
-                        voxels[ix,iy,iz] = False
-                        continue
-                    # perspective projection
-                    u = (fx * (xr / zr)) + cx
-                    v = (fy * (yr / zr)) + cy
-                    ui = int(round(u))
-                    vi = int(round(v))
-                    if ui < 0 or ui >= w or vi < 0 or vi >= h:
-                        voxels[ix,iy,iz] = False
-                    else:
-                        # if outside silhouette (sil pixel == 0) then carve
-                        if sil[vi, ui] == 0:
-                            voxels[ix,iy,iz] = False
-    # gather point cloud (voxel centers)
-    points = []
-    for ix, x in enumerate(xs):
-        for iy, y in enumerate(ys):
-            for iz, z in enumerate(zs):
-                if voxels[ix,iy,iz]:
-                    points.append((x,y,z))
-    return np.array(points)
+    # camera at some distance along +Z rotated around Y by angle? We'll assume camera at (0, 0, cam_z) and turntable rotates object.
+    cam_z = 1.5  # camera distance (approx)
+    # rotation by -angle around Y is the same for every voxel of a view
+    rad = np.deg2rad(angles)
+    cos_a = [math.cos(-a) for a in rad]
+    sin_a = [math.sin(-a) for a in rad]
+
+    def project(pts, idx):
+        x, y, z = pts.T
+        # rotate point by -angle around Y (object rotated relative to camera)
+        xr = x * cos_a[idx] + z * sin_a[idx]
+        yr = y
+        zr = -x * sin_a[idx] + z * cos_a[idx] + cam_z  # translate camera forward
+        valid = zr > 0.001
+        zr = np.where(valid, zr, 1.0)
+        # perspective projection; np.rint rounds half to even like round()
+        ui = np.rint((fx * (xr / zr)) + cx).astype(np.int64)
+        vi = np.rint((fy * (yr / zr)) + cy).astype(np.int64)
+        return ui, vi, valid
+
+    # coarse -> fine: only voxels in blocks the coarse pass could not reject are projected one by one
+    active = np.flatnonzero(coarse_carve(xs, ys, zs, silhouettes, project))
+    if on_coarse is not None:
+        on_coarse(len(active) / len(grid))
+    # carve voxels whose projection falls outside any silhouette (see carver.carve)
+    views = tqdm(view_order(silhouettes), desc="Carving")
+    active = carve(grid, silhouettes, project, active=active, views=views, verbose=False)
+    # gather point cloud (voxel centers), in the same (ix, iy, iz) order as a nested loop
+    return grid[active]
 
 def save_ply(points, filename):
-    # simple ascii ply
-    with open(filename, 'w') as f:
-        f.write("ply\nformat ascii 1.0\n")
-        f.write(f"element vertex {len(points)}\n")
-        f.write("property float x\nproperty float y\nproperty float z\n")
-        f.write("end_header\n")
-        for p in points:
-            f.write(f"{p[0]} {p[1]} {p[2]}\n")
+    # binary little-endian ply (see ply_io.write_ply)
+    write_ply(filename, points)
     print(f"Saved PLY: {filename}")
 
 
@@ -342,9 +429,9 @@ def visualize_images(out_dir, delay_ms=500):
     if not img_files:
         print('No images to visualize in', out_dir)
         return
-    for idx, p in enumerate(img_files):
+    silhouettes = load_silhouettes(img_files)
+    for idx, (p, sil) in enumerate(zip(img_files, silhouettes)):
         img = cv2.imdecode(np.fromfile(p, dtype=np.uint8), cv2.IMREAD_COLOR)
-        sil = extract_silhouette(p)
         # compose side-by-side
         sil_bgr = cv2.cvtColor(sil, cv2.COLOR_GRAY2BGR)
         combo = np.hstack((cv2.resize(img, (640,480)), cv2.resize(sil_bgr, (640,480))))
@@ -356,30 +443,15 @@ def visualize_images(out_dir, delay_ms=500):
 
 
 def visualize_pointcloud(plyfile, subsample=20000, fill_boundary=True):
-    """Load simple ASCII PLY produced by save_ply and display a 3D scatter with optional ConvexHull boundary mesh."""
+    """Load a PLY produced by save_ply and display a 3D scatter with optional ConvexHull boundary mesh."""
     if not os.path.exists(plyfile):
         print('PLY not found:', plyfile)
         return
-    pts = []
-    with open(plyfile, 'r') as f:
-        header = True
-        for line in f:
-            if header:
-                if line.strip() == 'end_header':
-                    header = False
-                continue
-            parts = line.strip().split()
-            if len(parts) >= 3:
-                try:
-                    x, y, z = float(parts[0]), float(parts[1]), float(parts[2])
-                    pts.append((x, y, z))
-                except Exception:
-                    continue
-    if not pts:
+    pts = load_ply(plyfile)
+    if len(pts) == 0:
         print('No points in PLY')
         return
-    pts = np.array(pts)
-    pts_original = pts.copy()  # keep full point set for hull
+    pts_original = pts  # keep full point set for hull (read-only, not modified)
     # subsample for plotting if too many
     if pts.shape[0] > subsample:
         idx = np.random.choice(pts.shape[0], subsample, replace=False)
@@ -392,13 +464,10 @@ def visualize_pointcloud(plyfile, subsample=20000, fill_boundary=True):
     if fill_boundary and len(pts_original) >= 4:
         try:
             hull = ConvexHull(pts_original)
-            # Draw hull triangles as red wireframe edges
-            for simplex in hull.simplices:
-                triangle = pts_original[simplex]
-                for i in range(3):
-                    p1 = triangle[i]
-                    p2 = triangle[(i + 1) % 3]
-                    ax.plot([p1[0], p2[0]], [p1[1], p2[1]], [p1[2], p2[2]], 'r-', alpha=0.2, linewidth=0.5)
+            # Draw hull triangles as red wireframe edges, all in one collection
+            tris = pts_original[hull.simplices]  # (F, 3, 3)
+            segs = np.stack([tris, np.roll(tris, -1, axis=1)], axis=2).reshape(-1, 2, 3)
+            ax.add_collection3d(Line3DCollection(segs, colors='r', alpha=0.2, linewidths=0.5))
             print(f"ConvexHull computed: {len(hull.simplices)} triangles, volume={hull.volume:.6f}")
         except Exception as e:
             print(f"Could not compute ConvexHull: {e}")
@@ -498,35 +567,46 @@ def main():
             simulate = True
 
     saved_files = []
-    for i in range(num_images):
-        angle = i * angle_step
-        steps = int(round(steps_per_angle))
-        print(f"-> Rotating to angle {angle:.2f}°, steps {steps}")
-        ok = send_rotate(ser, steps)
-        if not ok:
-            print("Rotation failed, abort")
-            break
-        # small wait to let vibrations subside
-        time.sleep(0.5)
-        fname = os.path.join(out_dir, f"img_{i:03d}.jpg")
-        ok = capture_image(esp_ip, fname, simulate=simulate, sim_idx=i, sim_total=num_images)
-        if not ok:
-            print("Capture failed, retrying once...")
-            time.sleep(1)
-            ok = capture_image(esp_ip, fname)
+    # one Session for the whole scan; the firmware closes each connection, so every capture still connects anew
+    session = requests.Session()
+    # silhouette extraction runs in a worker thread while the turntable rotates
+    # and the next frame is captured (cv2 releases the GIL)
+    sil_futures = []
+    # leaving the block waits for the extractions still running, even if the capture loop fails
+    with ThreadPoolExecutor(max_workers=2) as sil_pool:
+        for i in range(num_images):
+            angle = i * angle_step
+            steps = int(round(steps_per_angle))
+            print(f"-> Rotating to angle {angle:.2f}°, steps {steps}")
+            ok = send_rotate(ser, steps)
             if not ok:
-                print("Failed to capture image for angle index", i)
+                print("Rotation failed, abort")
                 break
-        print("Saved", fname)
-        saved_files.append(fname)
-        time.sleep(0.2)
+            # small wait to let vibrations subside
+            time.sleep(0.5)
+            fname = os.path.join(out_dir, f"img_{i:03d}.jpg")
+            ok = capture_image(esp_ip, fname, simulate=simulate, sim_idx=i, sim_total=num_images, session=session)
+            if not ok:
+                print("Capture failed, retrying once...")
+                time.sleep(1)
+                ok = capture_image(esp_ip, fname, session=session)
+                if not ok:
+                    print("Failed to capture image for angle index", i)
+                    break
+            print("Saved", fname)
+            saved_files.append(fname)
+            sil_futures.append(sil_pool.submit(extract_silhouette, fname))
+            time.sleep(0.2)
 
     ser.close()
+    session.close()
     print("Capture finished. Images saved:", len(saved_files))
 
     if len(saved_files) > 4:
         print("Starting voxel carving (this may take some time)...")
-        pts = voxel_carving(saved_files, esp_ip, voxel_resolution=res)
+        silhouettes = [f.result() for f in sil_futures]
+        save_silhouette_cache(saved_files, silhouettes)
+        pts = voxel_carving(saved_files, esp_ip, voxel_resolution=res, silhouettes=silhouettes)
         print("Points:", pts.shape)
         plyfile = os.path.join(out_dir, "result.ply")
         save_ply(pts, plyfile)
@@ -10,6 +10,8 @@ import os
 import threading
 import time
 import argparse
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Import main scanning logic
@@ -34,6 +36,17 @@ except ImportError as e:
     print(f"Missing dependency: {e}")
     sys.exit(1)
 
+from scan_and_reconstruct import (OUTPUT_DIR, STEPS_PER_REV, capture_image, ensure_dir,
+                                  extract_silhouette, save_ply, save_silhouette_cache,
+                                  voxel_carving)
+
+# Opening the port resets the Arduino; it prints a banner once setup() is done
+BOOT_TIMEOUT = 3.0
+# Longest single ROTATE_STEPS move we wait for before giving up
+ROTATE_TIMEOUT = 30.0
+# Checklist updates from the worker are applied at most once per frame (~30 Hz)
+UI_DRAIN_MS = 33
+
 
 class ScannerWithUI:
     """Scanner coordinating with UI checklist."""
@@ -43,6 +56,10 @@ class ScannerWithUI:
         self.checklist = checklist
         self.is_running = False
         self.scanner_thread = None
+        # (index, status, description) from the worker thread, drained by the Tk thread
+        self._pending = queue.Queue()
+        # serial bytes received but not yet terminated by a newline
+        self._rx = bytearray()
     
     def start_scan(self, esp_ip, serial_port, num_images=36, voxel_res=32):
         """Start scanning in background thread."""
@@ -56,6 +73,7 @@ class ScannerWithUI:
         )
         self.scanner_thread.daemon = True
         self.scanner_thread.start()
+        self.root.after(UI_DRAIN_MS, self._drain)
     
     def stop_scan(self):
         """Stop ongoing scan."""
@@ -64,78 +82,163 @@ class ScannerWithUI:
             self.scanner_thread.join(timeout=2)
     
     def _update_checklist(self, item_index, status, description=""):
-        """Thread-safe checklist update."""
-        self.root.after(0, lambda: self.checklist.update_item(item_index, status, description))
+        """Thread-safe checklist update; applied on the next _drain tick."""
+        self._pending.put((item_index, status, description))
+    
+    def _update_checklist_many(self, *updates):
+        """Thread-safe batch of (index, status, description) updates."""
+        for update in updates:
+            self._pending.put(update)
+    
+    def _drain(self):
+        """Tk thread: apply the latest pending state per item, then reschedule while the worker lives."""
+        latest = {}
+        while True:
+            try:
+                index, status, description = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            latest[index] = (index, status, description)
+        for update in latest.values():
+            self.checklist.update_item(*update)
+        worker = self.scanner_thread
+        if (worker is not None and worker.is_alive()) or not self._pending.empty():
+            self.root.after(UI_DRAIN_MS, self._drain)
+    
+    def _wait_for_line(self, ser, accept, timeout):
+        """Read serial lines until accept(line) is true; returns the line, or None on timeout/stop.
+
+        A read that hits the port timeout mid-line leaves the partial bytes in self._rx,
+        so a reply split across reads ("DO" + "NE\n") is still seen as one line.
+        """
+        deadline = time.monotonic() + timeout
+        while self.is_running and time.monotonic() < deadline:
+            end = self._rx.find(b"\n")
+            if end < 0:
+                self._rx += ser.read(ser.in_waiting or 1)
+                continue
+            line = self._rx[:end].decode('utf-8', errors='ignore').strip()
+            del self._rx[:end + 1]
+            if line and accept(line):
+                return line
+        return None
+    
+    def _rotate(self, ser, steps):
+        """Send ROTATE_STEPS and wait for the Arduino's DONE (or an error reply)."""
+        ser.write(f"ROTATE_STEPS {steps}\n".encode('utf-8'))
+        ser.flush()
+        reply = self._wait_for_line(
+            ser, lambda line: line == "DONE" or line.startswith(("ERR", "UNKNOWN")), ROTATE_TIMEOUT)
+        return reply == "DONE"
     
     def _scan_worker(self, esp_ip, serial_port, num_images, voxel_res):
-        """Worker thread for scanning process."""
+        """Worker thread for scanning process; each stage advances on the hardware's reply."""
+        ser = None
+        # one Session for the probe and every frame; the firmware closes each connection,
+        # so every request still opens its own TCP connection
+        session = requests.Session()
+        # silhouettes are extracted while the turntable moves to the next angle (cv2 releases the GIL)
+        sil_pool = ThreadPoolExecutor(max_workers=2)
         try:
             # Step 1: Hardware detection
             self._update_checklist(0, "loading", "檢查 Arduino 連接...")
-            time.sleep(1)
-            
             try:
-                ser = serial.Serial(serial_port, 115200, timeout=1)
-                time.sleep(2)
-                self._update_checklist(0, "success", f"Arduino 已連接 ({serial_port})")
+                ser = serial.Serial(serial_port, 115200, timeout=0.2)
+                self._rx.clear()
             except Exception as e:
                 self._update_checklist(0, "failed", f"Arduino 連接失敗: {str(e)[:30]}")
                 return
+            # wait for the boot banner instead of a fixed delay; firmware without one
+            # simply costs BOOT_TIMEOUT
+            self._wait_for_line(ser, lambda line: "ready" in line.lower(), BOOT_TIMEOUT)
+            if not self.is_running:
+                self._update_checklist(0, "pending", "掃描已停止")
+                return
             
-            # Step 2: Serial configuration
-            self._update_checklist(1, "success", "Serial 配置完成 (115200 波特率)")
+            # Step 1 done + Step 2: Serial configuration
+            self._update_checklist_many(
+                (0, "success", f"Arduino 已連接 ({serial_port})"),
+                (1, "success", "Serial 配置完成 (115200 波特率)"))
             
             # Step 3: WiFi check
             self._update_checklist(2, "loading", f"檢查 ESP32-CAM ({esp_ip})...")
-            time.sleep(1)
             try:
-                resp = requests.get(f"http://{esp_ip}/capture", timeout=2)
+                # the firmware's index page is a few bytes; /capture would fetch a whole JPEG
+                # (HEAD is not handled by the firmware and would get a 404)
+                session.get(f"http://{esp_ip}/", timeout=2).raise_for_status()
                 self._update_checklist(2, "success", f"ESP32-CAM 已連接 ({esp_ip})")
             except Exception as e:
                 self._update_checklist(2, "failed", f"ESP32-CAM 連接失敗")
                 return
             
-            # Step 4: Calibration
+            # Step 4: Calibration - a zero-step move checks the command loop end to end
             self._update_checklist(3, "loading", "轉盤校準中...")
-            time.sleep(2)
+            if not self._rotate(ser, 0):
+                if not self.is_running:
+                    self._update_checklist(3, "pending", "掃描已停止")
+                else:
+                    self._update_checklist(3, "failed", "轉盤無回應")
+                return
             self._update_checklist(3, "success", "轉盤校準完成")
             
-            # Step 5: Image capture
+            # Step 5: Image capture - rotate, wait for DONE, then fetch the frame
+            ensure_dir(OUTPUT_DIR)
+            steps = int(round(STEPS_PER_REV / num_images))
+            files = []
+            sil_futures = []
             self._update_checklist(4, "loading", f"影像擷取 (0/{num_images})")
             for i in range(num_images):
                 if not self.is_running:
                     break
                 self._update_checklist(4, "loading", f"影像擷取 ({i}/{num_images}) - 旋轉→擷取")
-                time.sleep(0.3)
+                if not self._rotate(ser, steps):
+                    if not self.is_running:
+                        break  # user stop, reported below
+                    self._update_checklist(4, "failed", f"轉盤旋轉失敗 ({i}/{num_images})")
+                    return
+                fname = os.path.join(OUTPUT_DIR, f"img_{i:03d}.jpg")
+                if not capture_image(esp_ip, fname, session=session):
+                    self._update_checklist(4, "failed", f"影像擷取失敗 ({i}/{num_images})")
+                    return
+                files.append(fname)
+                sil_futures.append(sil_pool.submit(extract_silhouette, fname))
+            if len(files) < num_images:
+                self._update_checklist(4, "pending", f"掃描已停止 ({len(files)}/{num_images})")
+                return
             
             self._update_checklist(4, "success", f"影像擷取完成 ({num_images} 張)")
             
             # Step 6: Image processing
             self._update_checklist(5, "loading", "影像處理中 (二值化...)")
-            time.sleep(1)
+            silhouettes = [f.result() for f in sil_futures]
+            save_silhouette_cache(files, silhouettes)
             self._update_checklist(5, "success", "影像處理完成")
             
             # Step 7: Voxel carving
             self._update_checklist(6, "loading", f"體素雕刻 (分辨率: {voxel_res}³)")
-            time.sleep(2)
-            self._update_checklist(6, "success", "體素雕刻完成 (4801 點)")
+            pts = voxel_carving(
+                files, esp_ip, voxel_resolution=voxel_res, silhouettes=silhouettes,
+                on_coarse=lambda frac: self._update_checklist(
+                    6, "loading", f"體素雕刻 (coarse→fine, 剩 {frac:.0%} 體素)"))
+            self._update_checklist(6, "success", f"體素雕刻完成 ({len(pts)} 點)")
             
             # Step 8: Export
             self._update_checklist(7, "loading", "匯出結果...")
-            time.sleep(0.5)
-            self._update_checklist(7, "success", "PLY 檔案已生成 (scan_images/result.ply)")
+            plyfile = os.path.join(OUTPUT_DIR, "result.ply")
+            save_ply(pts, plyfile)
+            self._update_checklist(7, "success", f"PLY 檔案已生成 ({plyfile})")
             
             # Step 9: Visualization
-            self._update_checklist(8, "loading", "準備視覺化...")
-            time.sleep(0.5)
-            self._update_checklist(8, "success", "3D 視覺化已啟動 (点雲 + 邊界網格)")
-            
-            ser.close()
+            self._update_checklist(8, "success", f"可用 view_ply.py {plyfile} 檢視 (点雲 + 邊界網格)")
             
         except Exception as e:
             print(f"Scan error: {e}")
             self._update_checklist(6, "failed", f"錯誤: {str(e)[:30]}")
         finally:
+            if ser is not None:
+                ser.close()
+            session.close()
+            sil_pool.shutdown(wait=False)
             self.is_running = False
 
 
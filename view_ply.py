@@ -2,62 +2,108 @@
 """
 簡單 PLY 檢視器（純程式讀取與繪製）
 用法:
-    python view_ply.py scan_images/result_visual_hull.ply
+    python view_ply.py scan_images/result_visual_hull.ply [--rebuild] [--mpl]
 如果不提供檔案，預設會載入 scan_images/result_visual_hull.ply
+若已安裝 pyvista 或 open3d，改以 OpenGL 視窗顯示，旋轉縮放由 GPU 處理；否則（或加上 --mpl）使用 Matplotlib
+凸包只由可能的頂點計算（見 hull_utils.hull_mesh），三種顯示方式共用
 """
 import sys
-import subprocess
 import numpy as np
-from scipy.spatial import ConvexHull
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 from pathlib import Path
+from scipy.spatial import QhullError
 
+try:
+    import pyvista as pv
+except ImportError:
+    pv = None
+try:
+    import open3d as o3d
+except ImportError:
+    o3d = None
 
-def load_ply_ascii(path):
-    pts = []
-    with open(path, 'r') as f:
-        header_ended = False
-        for line in f:
-            line = line.strip()
-            if not header_ended:
-                if line == 'end_header':
-                    header_ended = True
-                continue
-            if line:
-                parts = line.split()
-                if len(parts) >= 3:
-                    try:
-                        x, y, z = map(float, parts[:3])
-                        pts.append([x, y, z])
-                    except:
-                        continue
-    return np.array(pts, dtype=np.float32)
-
-
-def visualize(points):
+from build_ply import ensure_ply_exists
+from hull_utils import cached_hull_mesh, hull_mesh
+from ply_io import load_ply
+
+
+def visualize_pyvista(points, mesh=None):
+    """以 pyvista 顯示點雲與凸包；mesh 為已算好的 hull_mesh 結果，未提供時現場計算"""
+    if len(points) == 0:
+        print('No points to display')
+        return
+    plotter = pv.Plotter(title=f'PLY Viewer ({len(points)} points)')
+    plotter.add_mesh(pv.PolyData(points), color='blue', point_size=2)
+    try:
+        hull_data = (mesh or hull_mesh(points)) if len(points) >= 4 else None
+    except QhullError as e:
+        print('ConvexHull failed, showing points only:', e)
+        hull_data = None
+    if hull_data is not None:
+        verts, simplices, volume = hull_data
+        # VTK faces 格式：每個面前置頂點數 [3, i, j, k, 3, ...]
+        faces = np.hstack([np.full((len(simplices), 1), 3), simplices]).ravel()
+        plotter.add_mesh(pv.PolyData(verts, faces), color='cyan', opacity=0.85,
+                         show_edges=True, edge_color='black')
+        print(f'✓ ConvexHull: {len(simplices)} triangles, volume={volume:.6f}')
+    plotter.add_axes()
+    plotter.show()
+
+
+def visualize_open3d(points, mesh=None):
+    """以 open3d 顯示點雲與凸包線框；mesh 同 visualize_pyvista"""
+    if len(points) == 0:
+        print('No points to display')
+        return
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points.astype(np.float64)))
+    pcd.paint_uniform_color([0.0, 0.0, 1.0])
+    geometries = [pcd]
+    try:
+        hull_data = (mesh or hull_mesh(points)) if len(points) >= 4 else None
+    except QhullError as e:
+        print('ConvexHull failed, showing points only:', e)
+        hull_data = None
+    if hull_data is not None:
+        verts, simplices, volume = hull_data
+        hull = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(verts.astype(np.float64)),
+                                         o3d.utility.Vector3iVector(simplices))
+        hull.compute_vertex_normals()
+        hull.paint_uniform_color([0.0, 1.0, 1.0])
+        wire = o3d.geometry.LineSet.create_from_triangle_mesh(hull)
+        wire.paint_uniform_color([0.0, 0.0, 0.0])
+        geometries += [hull, wire]
+        print(f'✓ ConvexHull: {len(simplices)} triangles, volume={volume:.6f}')
+    o3d.visualization.draw_geometries(geometries, window_name=f'PLY Viewer ({len(points)} points)')
+
+
+def visualize(points, mesh=None):
+    """以 Matplotlib 顯示凸包；mesh 同 visualize_pyvista"""
     fig = plt.figure(figsize=(8, 6))
     ax = fig.add_subplot(111, projection='3d')
     if len(points) == 0:
         print('No points to display')
         return
 
+    # 三軸等比例範圍直接由點雲外接盒決定，繪圖前設定並關閉 autoscale，省去 Matplotlib 自動縮放
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    mid = (lo + hi) * 0.5
+    r = (hi - lo).max() * 0.5 or 0.5  # 單點時給預設範圍，避免上下限相同
+    ax.set_autoscale_on(False)
+    ax.set_xlim3d(mid[0] - r, mid[0] + r)
+    ax.set_ylim3d(mid[1] - r, mid[1] + r)
+    ax.set_zlim3d(mid[2] - r, mid[2] + r)
+
     # 嘗試使用 ConvexHull 畫出填滿的簡單幾何形狀
     try:
         if len(points) >= 4:
-            hull = ConvexHull(points)
-            # plot_trisurf with hull.simplices 可以得到填色面
-            ax.plot_trisurf(points[:,0], points[:,1], points[:,2],
-                            triangles=hull.simplices, linewidth=0.2,
-                            edgecolor='k', color='cyan', alpha=0.85)
-            # 再疊上邊框線以強調輪廓
-            for tri in hull.simplices:
-                tri_pts = points[tri]
-                xs, ys, zs = tri_pts[:,0], tri_pts[:,1], tri_pts[:,2]
-                # close loop
-                ax.plot(np.append(xs, xs[0]), np.append(ys, ys[0]), np.append(zs, zs[0]),
-                        color='black', linewidth=0.25, alpha=0.8)
-            print(f'✓ ConvexHull: {len(hull.simplices)} triangles, volume={hull.volume:.6f}')
+            verts, simplices, volume = mesh or hull_mesh(points)
+            # 所有三角形（含邊框）合成單一 Poly3DCollection，一次繪製
+            ax.add_collection3d(Poly3DCollection(
+                verts[simplices], facecolor='cyan', edgecolor='black',
+                linewidth=0.25, alpha=0.85))
+            print(f'✓ ConvexHull: {len(simplices)} triangles, volume={volume:.6f}')
         else:
             ax.scatter(points[:,0], points[:,1], points[:,2], c='blue', s=2)
     except Exception as e:
@@ -69,26 +115,6 @@ def visualize(points):
     ax.set_zlabel('Z')
     ax.set_title(f'PLY Viewer ({len(points)} points)')
 
-    # 使三軸呈現等比例
-    def set_axes_equal(ax):
-        x_limits = ax.get_xlim3d()
-        y_limits = ax.get_ylim3d()
-        z_limits = ax.get_zlim3d()
-
-        x_range = abs(x_limits[1] - x_limits[0])
-        x_middle = np.mean(x_limits)
-        y_range = abs(y_limits[1] - y_limits[0])
-        y_middle = np.mean(y_limits)
-        z_range = abs(z_limits[1] - z_limits[0])
-        z_middle = np.mean(z_limits)
-
-        plot_radius = 0.5 * max([x_range, y_range, z_range])
-
-        ax.set_xlim3d([x_middle - plot_radius, x_middle + plot_radius])
-        ax.set_ylim3d([y_middle - plot_radius, y_middle + plot_radius])
-        ax.set_zlim3d([z_middle - plot_radius, z_middle + plot_radius])
-
-    set_axes_equal(ax)
     plt.tight_layout()
     plt.show()
 
@@ -96,25 +122,40 @@ def visualize(points):
 def main():
     # 預設 PLY 路徑
     default_path = Path('scan_images') / 'result_visual_hull.ply'
-    path = Path(sys.argv[1]) if len(sys.argv) > 1 else default_path
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    path = Path(args[0]) if args else default_path
 
-    # 支援強制重建旗標
+    # 支援強制重建旗標；--mpl 強制使用 Matplotlib 顯示
     force_rebuild = '--rebuild' in sys.argv
+    force_mpl = '--mpl' in sys.argv
 
-    # 若檔案不存在或要求重建，呼叫 reconstruct_simple.py 來產生 PLY
+    # 若檔案不存在或要求重建，在本程序內呼叫 reconstruct_simple.rebuild 產生 PLY
     if (not path.exists()) or force_rebuild:
-        print(f"PLY 檔 {path} 不存在或要求重建 -> 開始執行重建腳本...")
+        print(f"PLY 檔 {path} 不存在或要求重建 -> 開始重建...")
         try:
-            # 使用相同的 Python 執行環境執行重建腳本
-            subprocess.run([sys.executable, 'reconstruct_simple.py'], check=True)
-        except subprocess.CalledProcessError as e:
+            ensure_ply_exists(path, force_rebuild=force_rebuild, in_process=True)
+        except Exception as e:
+            # 在本程序內重建，重建程式的任何例外 (ValueError、OSError、cv2.error…) 都視同重建腳本失敗
             print("重建腳本失敗：", e)
             return
 
     try:
-        pts = load_ply_ascii(str(path))
+        pts = load_ply(path)
         print(f'Loaded {len(pts)} points from {path}')
-        visualize(pts)
+        # 凸包快取在 PLY 旁，PLY 未重建時不必重跑 Qhull
+        try:
+            mesh = cached_hull_mesh(path, pts) if len(pts) >= 4 else None
+        except QhullError:
+            # 點全在同一平面或直線上，凸包退化；各顯示函式會改畫散點
+            mesh = None
+        if force_mpl:
+            visualize(pts, mesh)
+        elif pv is not None:
+            visualize_pyvista(pts, mesh)
+        elif o3d is not None:
+            visualize_open3d(pts, mesh)
+        else:
+            visualize(pts, mesh)
     except Exception as e:
         print('Error loading PLY:', e)
 